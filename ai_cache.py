@@ -0,0 +1,158 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from database import get_db_connection
+from lru import LRUCache
+
+# Настройки кэша ответов YandexGPT
+AI_CACHE_SIZE = int(os.environ.get('AI_CACHE_SIZE', 1024))
+AI_CACHE_TTL = float(os.environ.get('AI_CACHE_TTL', 3600))
+# Общий для всех воркеров уровень в SQLite (0 — только память процесса)
+AI_CACHE_SHARED = os.environ.get('AI_CACHE_SHARED', '1') != '0'
+AI_CACHE_SHARED_MAX_ROWS = int(os.environ.get('AI_CACHE_SHARED_MAX_ROWS', 100000))
+# Сколько ждать ответа «ведущего» запроса при одинаковых параллельных запросах
+AI_CACHE_WAIT_TIMEOUT = float(os.environ.get('AI_CACHE_WAIT_TIMEOUT', 60))
+# Раз в сколько записей чистить просроченные строки в SQLite
+_PRUNE_EVERY = 256
+
+
+def make_key(*parts):
+    """Ключ кэша: хэш от нормализованных частей запроса"""
+    normalized = '\x1f'.join(' '.join(str(p).split()).casefold() for p in parts)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+class _Flight:
+    __slots__ = ('event', 'value')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+
+
+class ResponseCache:
+    """
+    Двухуровневый кэш готовых ответов: LRU с TTL в памяти процесса и
+    общая таблица ai_response_cache в SQLite. Одинаковые параллельные запросы
+    внутри процесса объединяются (single-flight) — в апстрим уходит один.
+    """
+
+    def __init__(self, maxsize=AI_CACHE_SIZE, ttl=AI_CACHE_TTL, shared=AI_CACHE_SHARED):
+        self.ttl = ttl
+        self.shared = shared
+        self._memory = LRUCache(maxsize, ttl)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.shared_hits = 0
+        self.shared_evictions = 0
+        self.coalesced = 0
+        self.upstream_calls = 0
+
+    def _shared_get(self, key):
+        try:
+            with get_db_connection() as conn:
+                row = conn.execute(
+                    "SELECT response FROM ai_response_cache WHERE key = ? AND expires_at > ?",
+                    (key, time.time())
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"AI cache read error: {e}")
+            return None
+        return row['response'] if row else None
+
+    def _shared_put(self, key, value):
+        now = time.time()
+        try:
+            with get_db_connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO ai_response_cache (key, response, expires_at) VALUES (?, ?, ?)",
+                    (key, value, now + self.ttl)
+                )
+                self._puts += 1
+                if self._puts % _PRUNE_EVERY == 0:
+                    removed = conn.execute(
+                        "DELETE FROM ai_response_cache WHERE expires_at <= ?", (now,)
+                    ).rowcount
+                    removed += conn.execute('''
+                        DELETE FROM ai_response_cache WHERE key IN (
+                            SELECT key FROM ai_response_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?
+                        )
+                    ''', (AI_CACHE_SHARED_MAX_ROWS,)).rowcount
+                    self.shared_evictions += removed
+        except sqlite3.Error as e:
+            print(f"AI cache write error: {e}")
+
+    def get(self, key):
+        value = self._memory.get(key)
+        if value is None and self.shared:
+            value = self._shared_get(key)
+            if value is not None:
+                self.shared_hits += 1
+                self._memory.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self._memory.put(key, value)
+        if self.shared:
+            self._shared_put(key, value)
+
+    def get_or_compute(self, key, compute):
+        """
+        Возвращает ответ из кэша или вычисляет его через compute().
+        Пустой результат (None) не кэшируется — следующий запрос попробует снова.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[key] = flight
+
+        if not leader:
+            self.coalesced += 1
+            flight.event.wait(AI_CACHE_WAIT_TIMEOUT)
+            return flight.value
+
+        try:
+            self.upstream_calls += 1
+            value = compute()
+            if value is not None:
+                self.put(key, value)
+            flight.value = value
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    def clear(self):
+        self._memory.clear()
+        if self.shared:
+            with get_db_connection() as conn:
+                conn.execute("DELETE FROM ai_response_cache")
+
+    def stats(self):
+        memory = self._memory.stats()
+        return {
+            "hits": memory["hits"],
+            "shared_hits": self.shared_hits,
+            "misses": memory["misses"] - self.shared_hits,
+            "evictions": memory["evictions"] + memory["expirations"],
+            "shared_evictions": self.shared_evictions,
+            "coalesced": self.coalesced,
+            "upstream_calls": self.upstream_calls,
+            "size": memory["size"],
+            "maxsize": memory["maxsize"],
+        }
+
+
+# Общий кэш процесса для клиента YandexGPT
+response_cache = ResponseCache()
@@ -1,30 +1,106 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, g, stream_with_context
 from flask_cors import CORS
-from werkzeug.security import generate_password_hash, check_password_hash
 import datetime
 import jwt
+import json
+import time
 from functools import wraps
-from yandex_ai import init_yandex_gpt
+from yandex_ai import YANDEX_POOL_SIZE, init_yandex_gpt
 import os
 
+import http_cache
+import metrics
+
 from database import init_db, get_db_connection
-from prompt_builder import build_prompt
+from prompt_builder import (
+    BUILD_BATCH_MAX_ITEMS, BUILD_BATCH_WORKERS, _template_cache, build_prompt, build_prompt_stream, build_prompts_batch,
+)
+from ai_cache import response_cache
+from near_duplicates import similarity_index
+from token_cache import token_cache
+from password_hashing import HashingOverloaded, password_hasher
+from prompt_store import (
+    HISTORY_DEFAULT_LIMIT, SAVE_BATCH_MAX_ITEMS, SEARCH_DEFAULT_LIMIT, SaveQueueFull,
+    fetch_history, get_user_version, load_last_prompts, prompt_writer, search_history,
+)
+from yandex_ai import YandexGPTStreamError
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Next-Cursor', 'Server-Timing', 'ETag'])
+
+# Запросы дольше этого порога (мс) пишутся в лог одной JSON-строкой с разбивкой по этапам; 0 — выключено
+SLOW_REQUEST_LOG_MS = float(os.environ.get('SLOW_REQUEST_LOG_MS', 0))
 
 YANDEX_API_KEY = os.environ.get('YANDEX_API_KEY')
 YANDEX_FOLDER_ID = os.environ.get('YANDEX_FOLDER_ID')
-if YANDEX_API_KEY and YANDEX_FOLDER_ID:
-    init_yandex_gpt(YANDEX_API_KEY, YANDEX_FOLDER_ID)
-    print("YandexGPT инициализирован успешно")
-else:
-    print("YandexGPT не настроен: проверьте переменные окружения YANDEX_API_KEY и YANDEX_FOLDER_ID")
-    
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'secret-key-for-local-pc-launch-default')
 
-# Инициализируем БД 
-init_db()
+# При запуске `python app.py` процессы пула хэширования паролей (forkserver/spawn)
+# импортируют этот файл заново как __mp_main__: подключаться к YandexGPT и БД им незачем
+if __name__ != '__mp_main__':
+    if YANDEX_API_KEY and YANDEX_FOLDER_ID:
+        # Сессию делят потоки запросов и все потоки пакетной генерации: при меньшем
+        # пуле urllib3 выбрасывает лишние соединения («Connection pool is full»)
+        init_yandex_gpt(YANDEX_API_KEY, YANDEX_FOLDER_ID, pool_size=YANDEX_POOL_SIZE + BUILD_BATCH_WORKERS)
+        print("YandexGPT инициализирован успешно")
+    else:
+        print("YandexGPT не настроен: проверьте переменные окружения YANDEX_API_KEY и YANDEX_FOLDER_ID")
+
+    # Инициализируем БД 
+    init_db()
+
+# --- МЕТРИКИ ---
+metrics.register_collector('ai_cache', 'Кэш ответов YandexGPT', response_cache.stats)
+metrics.register_collector('token_cache', 'Кэш проверенных JWT', token_cache.stats)
+metrics.register_collector('template_cache', 'Кэш скомпилированных шаблонов', _template_cache.stats)
+metrics.register_collector('password_hasher', 'Пул хэширования паролей', password_hasher.stats)
+metrics.register_collector('prompt_writer', 'Очередь записи промптов', prompt_writer.stats)
+if similarity_index is not None:
+    metrics.register_collector('ai_reuse', 'Повторное использование ответов на похожие запросы', similarity_index.stats)
+
+@app.before_request
+def _start_request_timer():
+    metrics.begin_request()
+    g.request_start = time.perf_counter()
+
+def observe_request(endpoint, method, status, elapsed):
+    """
+    Записывает длительность запроса в метрики и при необходимости в лог медленных
+    запросов. Возвращает значение заголовка Server-Timing (общее для Flask и ASGI).
+    """
+    metrics.REQUEST_DURATION.observe(elapsed, endpoint, str(status))
+    spans = metrics.request_spans() + [('total', elapsed)]
+    if SLOW_REQUEST_LOG_MS and elapsed * 1000 >= SLOW_REQUEST_LOG_MS:
+        print(json.dumps({
+            "event": "slow_request",
+            "endpoint": endpoint,
+            "method": method,
+            "status": status,
+            "duration_ms": round(elapsed * 1000, 2),
+            "stages": [{"stage": stage, "ms": round(seconds * 1000, 2)} for stage, seconds in spans[:-1]],
+        }, ensure_ascii=False))
+    return metrics.server_timing_header(spans)
+
+@app.after_request
+def _record_request_timing(response):
+    # Для потоковых ответов здесь учитывается время до начала отдачи тела
+    start = g.pop('request_start', None)
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    response.headers['Server-Timing'] = observe_request(
+        request.endpoint or 'not_found', request.method, response.status_code, elapsed)
+    return response
+
+@app.after_request
+def _compress_response(response):
+    # Зарегистрирован после _record_request_timing, поэтому выполняется раньше и попадает в замер
+    with metrics.span('compress'):
+        return http_cache.compress_response(response, request.accept_encodings)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 # --- ДЕКОРАТОР JWT ---
 def token_required(f):
@@ -38,7 +114,8 @@ def token_required(f):
         if not token:
             return jsonify({"error": "Токен отсутствует"}), 401
         try:
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+            with metrics.span('auth'):
+                data = token_cache.decode(token, app.config['SECRET_KEY'])
             current_user_id = data['user_id']
         except jwt.ExpiredSignatureError:
             return jsonify({"error": "Токен истёк"}), 401
@@ -59,7 +136,8 @@ def token_optional(f):
                 token = auth_header.split(" ")[1]
                 try:
                     # Пытаемся расшифровать токен
-                    data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+                    with metrics.span('auth'):
+                        data = token_cache.decode(token, app.config['SECRET_KEY'])
                     current_user_id = data['user_id']
                 except Exception:
                     # Если токен неверный или истек, мы не выдаем ошибку 401, 
@@ -69,6 +147,38 @@ def token_optional(f):
         # Передаем id (число или None) в функцию эндпоинта
         return f(current_user_id, *args, **kwargs)
     return decorated
+def _overloaded():
+    """Ответ 503 при переполненной очереди (хэширования паролей или записи промптов)"""
+    response = jsonify({"error": "Сервер перегружен, повторите позже"})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+def _rehash_if_needed(user, password):
+    """Пересчитывает хэш пароля, если сменились настройки хэширования"""
+    try:
+        if not password_hasher.needs_rehash(user['password_hash']):
+            return
+        new_hash = password_hasher.hash(password)
+    except HashingOverloaded:
+        return  # пересчитаем при следующем входе
+    with get_db_connection() as conn:
+        conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_hash, user['id']))
+    password_hasher.record_rehash()
+
+def _not_modified(etag):
+    """Ответ 304, если у клиента уже есть эта версия ответа (If-None-Match), иначе None"""
+    tag = http_cache.matching_etag(etag, request.if_none_match)
+    if tag is None:
+        return None
+    return _with_etag(Response(status=304), tag)
+
+def _with_etag(response, etag):
+    """ETag и заголовки, при которых браузер перепроверяет ответ при каждом запросе"""
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Authorization')
+    return response
+
 # --- ЭНДПОИНТЫ АВТОРИЗАЦИИ ---
 @app.route('/api/register', methods=['POST'])
 def register():
@@ -77,7 +187,10 @@ def register():
     password = data.get('password')
     if not username or not password:
         return jsonify({"error": "Заполните все поля"}), 400
-    hashed = generate_password_hash(password)
+    try:
+        hashed = password_hasher.hash(password)
+    except HashingOverloaded:
+        return _overloaded()
     try:
         with get_db_connection() as conn:
             conn.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, hashed))
@@ -93,7 +206,12 @@ def login():
     password = data.get('password')
     with get_db_connection() as conn:
         user = conn.execute("SELECT id, password_hash FROM users WHERE username = ?", (username,)).fetchone()
-    if user and check_password_hash(user['password_hash'], password):
+    try:
+        valid = bool(user) and password_hasher.verify(user['password_hash'], password)
+    except HashingOverloaded:
+        return _overloaded()
+    if valid:
+        _rehash_if_needed(user, password)
         token = jwt.encode({
             'user_id': user['id'],
             'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
@@ -109,42 +227,102 @@ def save_prompt(current_user_id):
     p_type = data.get('type')
     inp = data.get('input')
     out = data.get('output')
-    with get_db_connection() as conn:
-        conn.execute(
-            "INSERT INTO saved_prompts (user_id, prompt_type, input_text, output_text) VALUES (?, ?, ?, ?)",
-            (current_user_id, p_type, inp, out)
-        )
-        conn.commit()
+    try:
+        with metrics.span('db_save'):
+            prompt_writer.submit([(current_user_id, p_type, inp, out)], ack=data.get('ack'))
+    except SaveQueueFull:
+        return _overloaded()
     return jsonify({"success": True})
 
+@app.route('/api/save_prompts', methods=['POST'])
+@token_required
+def save_prompts_batch(current_user_id):
+    # Пакетное сохранение: {"prompts": [{"type", "input", "output"}, ...], "ack": "commit"|"enqueue"}
+    data = request.json
+    prompts = data.get('prompts')
+    if not isinstance(prompts, list) or not prompts:
+        return jsonify({"error": "prompts required"}), 400
+    if len(prompts) > SAVE_BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Не больше {SAVE_BATCH_MAX_ITEMS} промптов за запрос"}), 400
+    if not all(isinstance(p, dict) for p in prompts):
+        return jsonify({"error": "Неверный формат промпта"}), 400
+    rows = [(current_user_id, p.get('type'), p.get('input'), p.get('output')) for p in prompts]
+    try:
+        with metrics.span('db_save'):
+            prompt_writer.submit(rows, ack=data.get('ack'))
+    except SaveQueueFull:
+        return _overloaded()
+    return jsonify({"success": True, "saved": len(rows)})
+
 @app.route('/api/get_last_prompts', methods=['GET'])
 @token_required
 def get_last_prompts(current_user_id):
-    result = {"positive": None, "negative": None}
-    with get_db_connection() as conn:
-        pos = conn.execute(
-            "SELECT input_text, output_text FROM saved_prompts WHERE user_id = ? AND prompt_type = 'positive' ORDER BY created_at DESC LIMIT 1",
-            (current_user_id,)
-        ).fetchone()
-        if pos:
-            result["positive"] = {"input": pos['input_text'], "output": pos['output_text']}
-        neg = conn.execute(
-            "SELECT input_text, output_text FROM saved_prompts WHERE user_id = ? AND prompt_type = 'negative' ORDER BY created_at DESC LIMIT 1",
-            (current_user_id,)
-        ).fetchone()
-        if neg:
-            result["negative"] = {"input": neg['input_text'], "output": neg['output_text']}
-    return jsonify(result)
+    # ETag по версии истории пользователя: на повторный запрос без изменений — 304
+    with metrics.span('db_version'), get_db_connection() as conn:
+        version = get_user_version(conn, current_user_id)
+    etag = http_cache.make_etag(version, 'last_prompts', current_user_id)
+    not_modified = _not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+    return _with_etag(jsonify(load_last_prompts(current_user_id, version)), etag)
 
 @app.route('/api/history', methods=['GET'])
 @token_required
 def get_history(current_user_id):
-    with get_db_connection() as conn:
-        rows = conn.execute(
-            "SELECT prompt_type, input_text, output_text, created_at FROM saved_prompts WHERE user_id = ? ORDER BY created_at DESC",
-            (current_user_id,)
-        ).fetchall()
-    return jsonify([dict(row) for row in rows])
+    # Постраничная выдача: ?limit=&cursor=&type=&preview=1
+    # Курсор следующей страницы возвращается в заголовке X-Next-Cursor;
+    # ETag зависит от версии истории пользователя и параметров страницы
+    try:
+        limit = int(request.args.get('limit', HISTORY_DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({"error": "Неверный limit"}), 400
+    preview = request.args.get('preview', '').lower() in ('1', 'true', 'yes')
+    cursor = request.args.get('cursor')
+    prompt_type = request.args.get('type')
+    try:
+        with get_db_connection() as conn:
+            with metrics.span('db_version'):
+                version = get_user_version(conn, current_user_id)
+            etag = http_cache.make_etag(version, 'history', current_user_id, limit, cursor, prompt_type, preview)
+            not_modified = _not_modified(etag)
+            if not_modified is not None:
+                return not_modified
+            items, next_cursor = fetch_history(
+                conn, current_user_id, limit,
+                cursor=cursor,
+                prompt_type=prompt_type,
+                preview=preview
+            )
+    except ValueError:
+        return jsonify({"error": "Неверный курсор"}), 400
+    response = jsonify(items)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return _with_etag(response, etag)
+
+@app.route('/api/history/search', methods=['GET'])
+@token_required
+def search_history_endpoint(current_user_id):
+    # Полнотекстовый поиск: ?q=&limit=&cursor=&type=
+    # Результаты отсортированы по релевантности, курсор следующей страницы — в X-Next-Cursor
+    query = request.args.get('q', '')
+    try:
+        limit = int(request.args.get('limit', SEARCH_DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({"error": "Неверный limit"}), 400
+    try:
+        with metrics.span('db_search'), get_db_connection() as conn:
+            items, next_cursor = search_history(
+                conn, current_user_id, query, limit,
+                cursor=request.args.get('cursor'),
+                prompt_type=request.args.get('type')
+            )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    response = jsonify(items)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 # --- НОВЫЙ ЭНДПОИНТ: ГЕНЕРАЦИЯ ПРОМПТА ---
 @app.route('/api/build_prompt', methods=['POST'])
@@ -160,14 +338,122 @@ def build_prompt_endpoint(current_user_id):
     if not user_input:
         return jsonify({"error": "userInput required"}), 400
 
-    prompt_text, source = build_prompt(user_input, model_key, locale, auto_learn, use_instructions)
+    prompt_text, source, reused = build_prompt(user_input, model_key, locale, auto_learn, use_instructions)
     
     return jsonify({
         "prompt": prompt_text,
         "source": source,
-        "model": model_key
+        "model": model_key,
+        "reused": reused
     })
 
+def _batch_item_result(index, model_key, result):
+    """Элемент ответа пакетной генерации: результат или ошибка"""
+    if isinstance(result, Exception):
+        return {"index": index, "prompt": None, "source": None, "model": model_key, "reused": False,
+                "error": "Ошибка генерации"}
+    prompt_text, source, reused = result
+    return {"index": index, "prompt": prompt_text, "source": source, "model": model_key, "reused": reused,
+            "error": None}
+
+# --- ПАКЕТНАЯ ГЕНЕРАЦИЯ ПРОМПТОВ ---
+@app.route('/api/build_prompts', methods=['POST'])
+@token_optional
+def build_prompts_endpoint(current_user_id):
+    # {"items": [{"userInput", "modelKey", "locale", "use_instructions"}, ...], "stream": false}
+    # modelKey/locale/use_instructions верхнего уровня — значения по умолчанию для элементов.
+    # Ответ: {"results": [...]} в порядке items; при "stream": true — NDJSON по мере готовности
+    data = request.json
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items required"}), 400
+    if len(items) > BUILD_BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Не больше {BUILD_BATCH_MAX_ITEMS} элементов за запрос"}), 400
+    default_model = data.get('modelKey', 'default')
+    default_locale = data.get('locale', 'ru')
+    default_instructions = data.get('use_instructions', False)
+
+    # Ошибки отдельных элементов не отменяют весь пакет
+    invalid = []
+    tasks = []
+    task_indexes = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            invalid.append({"index": index, "prompt": None, "source": None, "model": None, "reused": False,
+                            "error": "Неверный формат элемента"})
+            continue
+        user_input = item.get('userInput')
+        model_key = item.get('modelKey', default_model)
+        locale = item.get('locale', default_locale)
+        if not user_input or not isinstance(user_input, str):
+            error = "userInput required"
+        elif not isinstance(model_key, str) or not isinstance(locale, str):
+            error = "Неверный modelKey или locale"
+        else:
+            error = None
+        if error:
+            invalid.append({"index": index, "prompt": None, "source": None,
+                            "model": model_key if isinstance(model_key, str) else None, "reused": False,
+                            "error": error})
+            continue
+        tasks.append((user_input, model_key, locale, bool(item.get('use_instructions', default_instructions))))
+        task_indexes.append(index)
+
+    def results():
+        yield from invalid
+        for positions, result in build_prompts_batch(tasks):
+            model_key = tasks[positions[0]][1]
+            for position in positions:
+                yield _batch_item_result(task_indexes[position], model_key, result)
+
+    if data.get('stream'):
+        return Response(
+            stream_with_context(json.dumps(item, ensure_ascii=False) + "\n" for item in results()),
+            mimetype='application/x-ndjson',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+
+    ordered = sorted(results(), key=lambda item: item['index'])
+    return jsonify({"results": ordered})
+
+def _sse(event, data):
+    """Форматирует одно событие Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# --- ПОТОКОВАЯ ГЕНЕРАЦИЯ ПРОМПТА (Server-Sent Events) ---
+@app.route('/api/build_prompt/stream', methods=['POST'])
+@token_optional
+def build_prompt_stream_endpoint(current_user_id):
+    data = request.json
+    user_input = data.get('userInput')
+    model_key = data.get('modelKey', 'default')
+    locale = data.get('locale', 'ru')
+    auto_learn = data.get('auto_learn', False)
+    use_instructions = data.get('use_instructions', False)
+
+    if not user_input:
+        return jsonify({"error": "userInput required"}), 400
+
+    def generate():
+        # Событие meta приходит один раз перед первым фрагментом и сообщает источник
+        source = None
+        try:
+            for chunk, chunk_source in build_prompt_stream(user_input, model_key, locale, auto_learn, use_instructions):
+                if source is None:
+                    source = chunk_source
+                    yield _sse("meta", {"source": source, "model": model_key})
+                yield _sse("chunk", {"text": chunk})
+        except YandexGPTStreamError:
+            yield _sse("error", {"error": "Генерация прервана", "source": source, "model": model_key})
+            return
+        yield _sse("done", {"source": source, "model": model_key})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
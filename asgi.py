@@ -0,0 +1,280 @@
+# Асинхронный режим сервера (ASGI).
+# /api/build_prompt обслуживается нативно в event loop: запрос к YandexGPT идёт
+# через httpx.AsyncClient, а fallback на БД выполняется в пуле потоков.
+# Остальные эндпоинты отдаются Flask-приложению через WsgiToAsgi.
+# Запуск: uvicorn asgi:app --workers 2
+import asyncio
+import json
+import os
+import time
+from typing import Optional, Tuple
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app as flask_app, observe_request, YANDEX_API_KEY, YANDEX_FOLDER_ID
+from prompt_builder import build_from_db
+from ai_cache import make_key
+import metrics
+from metrics import PROMPT_SOURCES, observe_stage
+from yandex_ai import YANDEX_POOL_SIZE, YandexGPTClient
+
+# Сколько запросов к YandexGPT процесс держит одновременно
+ASGI_MAX_CONCURRENCY = int(os.environ.get('ASGI_MAX_CONCURRENCY', 200))
+# Сколько запросов может ждать свободного слота; сверх этого — сразу 503
+ASGI_MAX_WAITING = int(os.environ.get('ASGI_MAX_WAITING', 1000))
+
+
+class _ConnectTrace:
+    """
+    Trace-колбэк httpx: время установки соединения (TCP + TLS) в одном запросе,
+    как у _TimedHTTPAdapter синхронного клиента
+    """
+    __slots__ = ('total', '_started')
+
+    def __init__(self):
+        self.total = 0.0
+        self._started = 0.0
+
+    async def __call__(self, event, info):
+        if event in ('connection.connect_tcp.started', 'connection.start_tls.started'):
+            self._started = time.perf_counter()
+        elif event in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+            self.total += time.perf_counter() - self._started
+
+    def observe(self):
+        if self.total:
+            observe_stage("upstream_connect", self.total)
+
+
+class AsyncYandexGPTClient(YandexGPTClient):
+    """Тот же клиент YandexGPT, но с асинхронным транспортом (httpx)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._flights = {}
+
+    def _make_session(self, pool_size: int):
+        connect_timeout, read_timeout = self.timeout
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            headers=self.headers,
+        )
+
+    async def _apost(self, body: dict) -> Optional[httpx.Response]:
+        """Асинхронный аналог _post: тот же разбор ответов и ошибок, другой транспорт"""
+        if not self._upstream_allowed():
+            return None
+
+        for attempt in range(self.max_retries + 1):
+            connect = _ConnectTrace()
+            start = time.perf_counter()
+            try:
+                response = await self.session.post(self.url, json=body, extensions={"trace": connect})
+            except httpx.HTTPError as e:
+                connect.observe()
+                delay = self._error_delay(e, attempt, isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)),
+                                          isinstance(e, httpx.TimeoutException))
+                if delay is None:
+                    return None
+                await asyncio.sleep(delay)
+                continue
+
+            connect.observe()
+            delay = self._response_delay(response, attempt, time.perf_counter() - start - connect.total)
+            if delay is None:
+                return response if response.status_code == 200 else None
+            await asyncio.sleep(delay)
+        return None
+
+    async def _acomplete(self, body: dict, instructions: str) -> Optional[str]:
+        response = await self._apost(body)
+        if response is None:
+            return None
+        try:
+            return self._result_text(response.json(), instructions)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            print(f"YandexGPT bad response: {e}")
+            return None
+
+    async def generate_async(self, user_input: str, model_key: str, locale: str = 'ru',
+                             use_instructions: bool = False) -> Tuple[Optional[str], bool]:
+        """Асинхронный аналог generate: (текст, reused)"""
+        clean_task, instructions, body = self._prepare(user_input, model_key, use_instructions)
+        if self.cache is None:
+            return await self._acomplete(body, instructions), False
+
+        # Кэш общий с синхронным клиентом; его SQLite-уровень читается вне event loop
+        key = make_key(self.model, model_key, clean_task, instructions)
+        cached = await asyncio.to_thread(self.cache.get, key)
+        if cached is not None:
+            return cached, False
+
+        scope = self._similar_scope(model_key, instructions)
+        if self.similar is not None:
+            similar = await asyncio.to_thread(self.similar.lookup, scope, clean_task)
+            if similar is not None:
+                return similar, True
+
+        # Single-flight внутри event loop: одинаковые запросы ждут один вызов апстрима
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.cache.coalesced += 1
+            return await asyncio.shield(flight), False
+
+        flight = asyncio.get_running_loop().create_future()
+        self._flights[key] = flight
+        try:
+            self.cache.upstream_calls += 1
+            result = await self._acomplete(body, instructions)
+            if result is not None:
+                await asyncio.to_thread(self.cache.put, key, result)
+                if self.similar is not None:
+                    await asyncio.to_thread(self.similar.add, scope, clean_task, result)
+            flight.set_result(result)
+            return result, False
+        except BaseException:
+            flight.set_result(None)
+            raise
+        finally:
+            del self._flights[key]
+
+    async def aclose(self):
+        await self.session.aclose()
+
+
+class Backpressure:
+    """
+    Ограничивает число одновременных вызовов апстрима.
+    Если в очереди ждёт больше max_waiting запросов, новые отклоняются сразу.
+    """
+
+    def __init__(self, limit: int, max_waiting: int):
+        self._semaphore = asyncio.Semaphore(limit)
+        self.max_waiting = max_waiting
+        self.waiting = 0
+
+    def try_enter(self) -> bool:
+        return self.waiting < self.max_waiting
+
+    async def __aenter__(self):
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        return self
+
+    async def __aexit__(self, *exc):
+        self._semaphore.release()
+
+
+async_client: Optional[AsyncYandexGPTClient] = None
+if YANDEX_API_KEY and YANDEX_FOLDER_ID:
+    async_client = AsyncYandexGPTClient(YANDEX_API_KEY, YANDEX_FOLDER_ID,
+                                        pool_size=max(YANDEX_POOL_SIZE, ASGI_MAX_CONCURRENCY))
+
+upstream_limit = Backpressure(ASGI_MAX_CONCURRENCY, ASGI_MAX_WAITING)
+
+
+async def build_prompt_async(user_input, model_key, locale='ru', auto_learn=False, use_instructions=False):
+    """Асинхронный аналог prompt_builder.build_prompt: (текст, source, reused)"""
+    # 1. Пытаемся использовать ИИ
+    if async_client is not None:
+        async with upstream_limit:
+            ai_result, reused = await async_client.generate_async(user_input, model_key, locale, use_instructions)
+        if ai_result:
+            PROMPT_SOURCES.inc("ai")
+            return ai_result, "ai", reused
+
+    # 2. Fallback на БД (синхронный код — вне event loop)
+    db_result = await asyncio.to_thread(build_from_db, user_input, model_key, locale)
+    if db_result:
+        PROMPT_SOURCES.inc("database")
+        return db_result, "database", False
+
+    # 3. Абсолютный fallback
+    PROMPT_SOURCES.inc("fallback")
+    return user_input, "fallback", False
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _send_json(send, status, payload, extra_headers=()):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    headers = [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(body)).encode()),
+        (b'access-control-allow-origin', b'*'),
+        (b'access-control-expose-headers', b'Server-Timing'),
+        *extra_headers,
+    ]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _build_prompt_response(receive):
+    """Разбирает запрос /api/build_prompt и строит ответ: (статус, JSON, доп. заголовки)"""
+    try:
+        data = json.loads(await _read_body(receive) or b'null')
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return 400, {"error": "JSON body required"}, []
+
+    user_input = data.get('userInput')
+    model_key = data.get('modelKey', 'default')
+    locale = data.get('locale', 'ru')
+    auto_learn = data.get('auto_learn', False)
+    use_instructions = data.get('use_instructions', False)
+
+    if not user_input:
+        return 400, {"error": "userInput required"}, []
+
+    if not upstream_limit.try_enter():
+        return 503, {"error": "Сервер перегружен, повторите позже"}, [(b'retry-after', b'1')]
+
+    prompt_text, source, reused = await build_prompt_async(user_input, model_key, locale, auto_learn, use_instructions)
+    return 200, {"prompt": prompt_text, "source": source, "model": model_key, "reused": reused}, []
+
+
+async def build_prompt_endpoint(scope, receive, send):
+    # Те же метрики и Server-Timing, что у Flask-эндпоинта (имя эндпоинта тоже Flask-овское)
+    metrics.begin_request()
+    start = time.perf_counter()
+    status, payload, headers = await _build_prompt_response(receive)
+    server_timing = observe_request('build_prompt_endpoint', scope['method'], status, time.perf_counter() - start)
+    headers.append((b'server-timing', server_timing.encode()))
+    await _send_json(send, status, payload, headers)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if async_client is not None:
+                await async_client.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+    elif scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == '/api/build_prompt':
+        await build_prompt_endpoint(scope, receive, send)
+    else:
+        await wsgi_app(scope, receive, send)
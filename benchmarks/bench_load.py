@@ -0,0 +1,130 @@
+import argparse
+import http.client
+import itertools
+import json
+import os
+import threading
+import time
+
+from benchmarks.common import max_rss_mb, summarize, use_temp_database
+
+# Доля времени на каждый эндпоинт не смешивается: эндпоинты нагружаются по очереди
+ENDPOINTS = ('build_prompt', 'history', 'save_prompt')
+
+
+class Client:
+    """Keep-alive HTTP-клиент одного потока нагрузки"""
+
+    def __init__(self, port, token):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        self.headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {token}'}
+
+    def request(self, method, path, payload=None):
+        body = json.dumps(payload) if payload is not None else None
+        try:
+            self.conn.request(method, path, body=body, headers=self.headers)
+            response = self.conn.getresponse()
+            response.read()
+            return response.status
+        except (http.client.HTTPException, OSError):
+            self.conn.close()
+            return 0
+
+
+def _call(client, endpoint, n):
+    if endpoint == 'build_prompt':
+        # Уникальный текст, чтобы кэш ответов не скрывал вызов апстрима
+        return client.request('POST', '/api/build_prompt', {"userInput": f"напиши игру змейка {n}", "modelKey": "gpt-4o"})
+    if endpoint == 'history':
+        return client.request('GET', '/api/history?limit=50')
+    return client.request('POST', '/api/save_prompt', {"type": "positive", "input": f"вход {n}", "output": "выход"})
+
+
+def run_endpoint(port, token, endpoint, concurrency, duration):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = itertools.count()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        client = Client(port, token)
+        local = []
+        local_errors = 0
+        while time.perf_counter() < deadline:
+            t0 = time.perf_counter()
+            status = _call(client, endpoint, next(counter))
+            local.append(time.perf_counter() - t0)
+            if status != 200:
+                local_errors += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    result = summarize(latencies, time.perf_counter() - start)
+    result["errors"] = errors[0]
+    return result
+
+
+def run(concurrency, duration, stub_latency, error_rate, history_rows):
+    from benchmarks.stub_yandex import StubHandler, start_stub
+
+    use_temp_database()
+    stub, url = start_stub(latency=stub_latency, error_rate=error_rate)
+    os.environ['YANDEX_API_KEY'] = 'bench-key'
+    os.environ['YANDEX_FOLDER_ID'] = 'bench-folder'
+    os.environ['YANDEX_GPT_URL'] = url
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from app import app
+    from database import get_db_connection
+
+    class KeepAliveHandler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+
+    client = app.test_client()
+    client.post('/api/register', json={"username": "bench", "password": "bench"})
+    token = client.post('/api/login', json={"username": "bench", "password": "bench"}).get_json()['token']
+    with get_db_connection() as conn:
+        user_id = conn.execute("SELECT id FROM users WHERE username = 'bench'").fetchone()['id']
+        conn.executemany(
+            "INSERT INTO saved_prompts (user_id, prompt_type, input_text, output_text) VALUES (?, ?, ?, ?)",
+            [(user_id, 'positive', f"история {i}", "x" * 500) for i in range(history_rows)]
+        )
+
+    results = {}
+    try:
+        for endpoint in ENDPOINTS:
+            results[endpoint] = run_endpoint(port, token, endpoint, concurrency, duration)
+        results["stub"] = {"requests_served": StubHandler.requests_served}
+        results["process"] = {"max_rss_mb": max_rss_mb()}
+    finally:
+        server.shutdown()
+        stub.shutdown()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Нагрузочный тест эндпоинтов через заглушку YandexGPT")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10, help="секунд на каждый эндпоинт")
+    parser.add_argument('--stub-latency', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--history-rows', type=int, default=10000)
+    parser.add_argument('--json', action='store_true', help="вывести результат одной строкой JSON")
+    args = parser.parse_args()
+    results = run(args.concurrency, args.duration, args.stub_latency, args.error_rate, args.history_rows)
+    print(json.dumps(results, ensure_ascii=False) if args.json else json.dumps(results, indent=2, ensure_ascii=False))
@@ -0,0 +1,104 @@
+import argparse
+import itertools
+import json
+import os
+import time
+import tracemalloc
+
+from benchmarks.common import (
+    make_inputs, max_rss_mb, measure, populate_dictionary, use_temp_database,
+)
+
+# Размеры синтетических словарей (число ключевых слов)
+SIZES = {"10": 10, "1k": 1000, "100k": 100000}
+
+
+def bench_dictionary(label, size, iterations):
+    import database
+    import dictionary_cache
+    import prompt_builder
+
+    db_path = use_temp_database()
+    database.init_db()
+    keywords = populate_dictionary(db_path, size)
+    dictionary_cache.invalidate()
+    prompt_builder._template_cache.clear()
+
+    # Сборка снимка словаря: время, затем отдельно память (tracemalloc сильно замедляет сборку)
+    t0 = time.perf_counter()
+    dictionary_cache.get_snapshot('ru')
+    load_seconds = time.perf_counter() - t0
+    dictionary_cache.invalidate()
+    tracemalloc.start()
+    dictionary_cache.get_snapshot('ru')
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    inputs = itertools.cycle(make_inputs(keywords))
+    result = measure(lambda: prompt_builder.build_from_db(next(inputs), 'gpt-4o', 'ru'), iterations)
+    result["snapshot_load_ms"] = round(load_seconds * 1000, 2)
+    result["snapshot_peak_mb"] = round(peak / 1024 / 1024, 2)
+    result["snapshot_mb"] = round(retained / 1024 / 1024, 2)
+    return {f"build_from_db.{label}": result}
+
+
+def bench_build_prompt(iterations, stub_latency):
+    """build_prompt целиком: вызов заглушки YandexGPT без кэша ответов"""
+    import prompt_builder
+    import yandex_ai
+    from benchmarks.stub_yandex import start_stub
+
+    server, url = start_stub(latency=stub_latency)
+    yandex_ai.yandex_client = yandex_ai.YandexGPTClient('bench-key', 'bench-folder', cache=None, url=url)
+    counter = itertools.count()
+    try:
+        result = measure(lambda: prompt_builder.build_prompt(f"напиши api сервер {next(counter)}", 'gpt-4o'),
+                         iterations, warmup=10)
+    finally:
+        yandex_ai.yandex_client = None
+        server.shutdown()
+    return {"build_prompt.ai_stub": result}
+
+
+def bench_jwt(iterations):
+    """Декоратор token_required (с кэшем проверенных токенов) против голого jwt.decode"""
+    import datetime
+    import jwt
+    from app import app, token_required
+    from token_cache import token_cache
+
+    token = jwt.encode({
+        'user_id': 1,
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    }, app.config['SECRET_KEY'], algorithm="HS256")
+    view = token_required(lambda user_id: user_id)
+    results = {}
+    results["jwt.decode"] = measure(
+        lambda: jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"]), iterations)
+    with app.test_request_context(headers={'Authorization': f'Bearer {token}'}):
+        token_cache.clear()
+        results["jwt.token_required"] = measure(view, iterations)
+    return results
+
+
+def run(sizes, iterations, stub_latency):
+    results = {}
+    for label in sizes:
+        results.update(bench_dictionary(label, SIZES[label], iterations))
+    results.update(bench_build_prompt(max(iterations // 10, 50), stub_latency))
+    results.update(bench_jwt(iterations * 10))
+    results["process"] = {"max_rss_mb": max_rss_mb()}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Микробенчмарки build_from_db, build_prompt и JWT")
+    parser.add_argument('--sizes', default=','.join(SIZES), help="размеры словарей через запятую: 10,1k,100k")
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--stub-latency', type=float, default=0.0)
+    parser.add_argument('--json', action='store_true', help="вывести результат одной строкой JSON")
+    args = parser.parse_args()
+    # Настоящий YandexGPT в бенчмарках не используется
+    os.environ.pop('YANDEX_API_KEY', None)
+    results = run([s for s in args.sizes.split(',') if s], args.iterations, args.stub_latency)
+    print(json.dumps(results, ensure_ascii=False) if args.json else json.dumps(results, indent=2, ensure_ascii=False))
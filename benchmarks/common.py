@@ -0,0 +1,123 @@
+import json
+import os
+import random
+import resource
+import sqlite3
+import string
+import sys
+import tempfile
+import time
+
+# Бенчмарки запускаются из корня репозитория: python -m benchmarks.run
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+BASELINES_PATH = os.path.join(ROOT, 'benchmarks', 'baselines.json')
+
+
+def use_temp_database():
+    """Переключает database.DB_NAME на временный файл (до импорта app!)"""
+    import database
+    path = os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.db')
+    database.DB_NAME = path
+    database.close_db_connections()
+    database._pool = None
+    return path
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(latencies, elapsed):
+    """latencies — секунды; возвращает пропускную способность и перцентили в миллисекундах"""
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "throughput_rps": round(len(values) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 4),
+        "p95_ms": round(percentile(values, 95) * 1000, 4),
+        "p99_ms": round(percentile(values, 99) * 1000, 4),
+    }
+
+
+def measure(fn, iterations=1000, warmup=50):
+    """Вызывает fn() iterations раз и возвращает сводку по задержкам"""
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t0)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def max_rss_mb():
+    # ru_maxrss в Linux — в килобайтах
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def random_word(rng, length):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def populate_dictionary(db_path, keyword_count, keywords_per_category=10, locale='ru', seed=42):
+    """
+    Заполняет словарь синтетическими категориями, всего keyword_count ключевых слов.
+    Возвращает список ключевых слов (для генерации входных текстов).
+    """
+    rng = random.Random(seed)
+    category_count = max(1, keyword_count // keywords_per_category)
+    all_keywords = []
+    categories = []
+    keyword_rows = []
+    localized = []
+    for i in range(category_count):
+        keywords = [f"{random_word(rng, rng.randint(4, 9))}{i}" for _ in range(keywords_per_category)]
+        all_keywords.extend(keywords)
+        category_id = f"bench_{i}"
+        categories.append(('bench', category_id, rng.randint(1, 100)))
+        keyword_rows.extend((kw, category_id) for kw in keywords)
+        localized.append((
+            category_id, locale, f"эксперт {i}",
+            json.dumps([f"фраза {i}.{j}" for j in range(3)], ensure_ascii=False),
+            json.dumps([f"избегать {i}.{j}" for j in range(2)], ensure_ascii=False),
+            json.dumps([f"формат {i}"], ensure_ascii=False),
+        ))
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO categories (group_name, category_id, priority, keywords) VALUES (?, ?, ?, '[]')",
+            categories
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO category_keywords (keyword, category_id) VALUES (?, ?)",
+            keyword_rows
+        )
+        conn.executemany(
+            "INSERT INTO category_localized (category_id, locale, role, pos_phrases, neg_phrases, format_phrases) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            localized
+        )
+    conn.close()
+    return all_keywords
+
+
+def make_inputs(keywords, count=200, seed=7):
+    """Тексты запросов: обычные слова вперемешку с несколькими ключевыми словами словаря"""
+    rng = random.Random(seed)
+    inputs = []
+    for _ in range(count):
+        words = [random_word(rng, rng.randint(3, 8)) for _ in range(rng.randint(8, 30))]
+        for _ in range(rng.randint(0, 3)):
+            words.insert(rng.randrange(len(words) + 1), rng.choice(keywords))
+        inputs.append(' '.join(words))
+    return inputs
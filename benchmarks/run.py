@@ -0,0 +1,160 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+
+from benchmarks.common import BASELINES_PATH, ROOT
+
+# Для каких метрик рост — это регрессия, а для каких — падение
+HIGHER_IS_WORSE = ('p50_ms', 'p95_ms', 'p99_ms', 'max_rss_mb', 'snapshot_load_ms', 'snapshot_peak_mb', 'snapshot_mb')
+LOWER_IS_WORSE = ('throughput_rps',)
+# Разница во времени (мс, в том числе на одну операцию) меньше этой — шум измерения, а не регрессия
+MIN_DELTA_MS = 0.05
+# p99 по меньшему числу замеров — фактически максимум, сравнивать его бессмысленно
+MIN_COUNT_FOR_P99 = 1000
+# Абсолютные потолки, проверяемые и без базовых значений: снимок словаря
+# держит каждый воркер, и на 100k ключевых слов он не должен разрастаться
+# до сотен мегабайт (бор со словарём на узел занимал больше 200 МБ)
+LIMITS = {
+    'micro.build_from_db.100k.snapshot_peak_mb': 128,
+    'micro.build_from_db.100k.snapshot_mb': 64,
+}
+
+
+def run_suite(module, args):
+    """Каждый набор — отдельный процесс, чтобы память и глобальное состояние не смешивались"""
+    output = subprocess.run(
+        [sys.executable, '-m', module, '--json', *args],
+        cwd=ROOT, check=True, capture_output=True, text=True,
+    ).stdout
+    # Последняя строка — JSON с результатами (выше может быть вывод самого приложения)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def machine_info():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def load_baselines():
+    """Базовые значения по режимам ('full', 'quick'); файл старого формата — это режим full"""
+    if not os.path.exists(BASELINES_PATH):
+        return {}
+    with open(BASELINES_PATH, encoding='utf-8') as f:
+        baselines = json.load(f)
+    if "machine" in baselines:
+        return {"full": baselines}
+    return baselines
+
+
+def compare(current, baseline, tolerance):
+    """Возвращает список регрессий (метрика, было, стало)"""
+    regressions = []
+    current, baseline = flatten(current), flatten(baseline)
+    for name, value in current.items():
+        old = baseline.get(name)
+        if old is None or old == 0:
+            continue
+        group, metric = name.rsplit('.', 1)
+        if metric == 'p99_ms' and current.get(f"{group}.count", MIN_COUNT_FOR_P99) < MIN_COUNT_FOR_P99:
+            continue
+        if metric.endswith('_ms') and value - old < MIN_DELTA_MS:
+            continue
+        if metric == 'throughput_rps' and value and 1000 / value - 1000 / old < MIN_DELTA_MS:
+            continue  # то же для пропускной способности: время на одну операцию почти не изменилось
+        if metric in HIGHER_IS_WORSE and value > old * (1 + tolerance):
+            regressions.append((name, old, value))
+        elif metric in LOWER_IS_WORSE and value < old * (1 - tolerance):
+            regressions.append((name, old, value))
+    return regressions
+
+
+def check_limits(current):
+    """Возвращает список превышений абсолютных потолков (метрика, потолок, значение)"""
+    flat = flatten(current)
+    return [(name, limit, flat[name]) for name, limit in LIMITS.items() if flat.get(name, 0) > limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Запуск бенчмарков и сравнение с сохранёнными базовыми значениями")
+    parser.add_argument('--only', choices=('micro', 'load'))
+    parser.add_argument('--quick', action='store_true', help="короткий прогон без словаря на 100k")
+    parser.add_argument('--save-baseline', action='store_true', help="записать результат в benchmarks/baselines.json (для текущего режима)")
+    parser.add_argument('--tolerance', type=float,
+                        help="допустимое ухудшение (0.25 = 25%%; по умолчанию 0.25, для --quick 0.5)")
+    parser.add_argument('--output', help="куда дополнительно сохранить результат (JSON)")
+    args = parser.parse_args()
+
+    mode = 'quick' if args.quick else 'full'
+    # Короткий прогон заметно шумнее полного
+    tolerance = args.tolerance if args.tolerance is not None else (0.5 if args.quick else 0.25)
+    params = {}
+    results = {"machine": machine_info()}
+    if args.only in (None, 'micro'):
+        params["micro"] = ['--sizes', '10,1k', '--iterations', '500'] if args.quick else []
+        results["micro"] = run_suite('benchmarks.bench_micro', params["micro"])
+    if args.only in (None, 'load'):
+        params["load"] = ['--duration', '2', '--concurrency', '8', '--history-rows', '1000'] if args.quick else []
+        results["load"] = run_suite('benchmarks.bench_load', params["load"])
+    suites = [suite for suite in ('micro', 'load') if suite in results]
+
+    for name, value in sorted(flatten({suite: results[suite] for suite in suites}).items()):
+        print(f"{name:55} {value}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+    over_limit = check_limits({suite: results[suite] for suite in suites})
+    for name, limit, value in over_limit:
+        print(f"ПРЕВЫШЕН ПОТОЛОК {name}: {value} > {limit}")
+
+    # Прогоны с разными параметрами (--quick и полный) сравниваются только с базой своего режима
+    baselines = load_baselines()
+    if args.save_baseline:
+        baseline = baselines.setdefault(mode, {})
+        baseline["machine"] = results["machine"]
+        baseline.setdefault("params", {}).update(params)
+        for suite in suites:
+            baseline[suite] = results[suite]
+        with open(BASELINES_PATH, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, indent=2, ensure_ascii=False)
+        print(f"Базовые значения ({mode}) сохранены в {BASELINES_PATH}")
+        return 1 if over_limit else 0
+
+    baseline = baselines.get(mode)
+    if baseline is None:
+        print(f"Базовых значений для режима {mode} нет: запустите с --save-baseline")
+        return 1 if over_limit else 0
+    if baseline.get("machine") != results["machine"]:
+        print("Внимание: базовые значения сняты на другой машине, сравнение условное")
+    regressions = []
+    for suite in suites:
+        if suite not in baseline:
+            continue
+        if baseline.get("params", {}).get(suite) != params[suite]:
+            print(f"Базовые значения {suite} сняты с другими параметрами, сравнение пропущено")
+            continue
+        regressions += compare({suite: results[suite]}, {suite: baseline[suite]}, tolerance)
+    for name, old, new in regressions:
+        print(f"РЕГРЕССИЯ {name}: {old} -> {new}")
+    return 1 if regressions or over_limit else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
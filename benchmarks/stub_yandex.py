@@ -0,0 +1,82 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.common import ROOT  # noqa: F401  (добавляет корень репозитория в sys.path)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Имитация YandexGPT completion API с настраиваемой задержкой и долей ошибок"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    latency = 0.0
+    error_rate = 0.0
+    error_status = 503
+    requests_served = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        StubHandler.requests_served += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self._send(self.error_status, {"error": "stub error"})
+            return
+
+        task = request.get("messages", [{}])[-1].get("text", "")
+        text = f"Роль: эксперт. {task}. Формат: список."
+        if request.get("completionOptions", {}).get("stream"):
+            # Потоковый режим: JSON-объекты построчно, текст накопительный
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            words = text.split(' ')
+            for i in range(1, len(words) + 1):
+                line = json.dumps({"result": {"alternatives": [
+                    {"message": {"role": "assistant", "text": ' '.join(words[:i])}, "status": "ALTERNATIVE_STATUS_PARTIAL"}
+                ]}}, ensure_ascii=False).encode('utf-8') + b'\n'
+                self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+            return
+        self._send(200, {"result": {"alternatives": [{"message": {"role": "assistant", "text": text}}]}})
+
+
+def start_stub(latency=0.0, error_rate=0.0, port=0):
+    """Запускает заглушку в фоновом потоке; возвращает (server, url)"""
+    StubHandler.latency = latency
+    StubHandler.error_rate = error_rate
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/foundationModels/v1/completion"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Заглушка YandexGPT для нагрузочных тестов")
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.2, help="задержка ответа, секунды")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов 503 (0..1)")
+    args = parser.parse_args()
+    server, url = start_stub(args.latency, args.error_rate, args.port)
+    print(f"Stub YandexGPT: {url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
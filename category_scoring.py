@@ -0,0 +1,55 @@
+import os
+
+from models_config import MODELS_CONFIG
+
+# Сколько категорий оставлять в промпте, если для модели не задано max_categories
+MAX_CATEGORIES_DEFAULT = int(os.environ.get('MAX_CATEGORIES', 3))
+
+# Вес вхождения по числу границ слова (индекс — 0, 1 или 2 границы):
+# середина другого слова ("go" в "google") / граница только с одной стороны / отдельное слово
+BOUNDARY_WEIGHTS = (0.25, 0.5, 1.0)
+# Насколько вхождение в начале текста весомее вхождения в конце
+POSITION_BONUS = 0.5
+
+
+def max_categories_for(model_key):
+    return MODELS_CONFIG.get(model_key, {}).get('max_categories', MAX_CATEGORIES_DEFAULT)
+
+
+def _is_boundary(text, index):
+    return index < 0 or index >= len(text) or not text[index].isalnum()
+
+
+def score_categories(text, hits):
+    """
+    Оценивает категории по вхождениям их ключевых слов (результат KeywordMatcher.find).
+    Вклад вхождения = вес границ слова × бонус за позицию; повторы одного
+    и того же ключевого слова затухают как 1/k. Все категории оцениваются
+    за один проход по списку вхождений.
+    Возвращает {category_id: score}.
+    """
+    length = max(len(text), 1)
+    scores = {}
+    for category_id, positions in hits.items():
+        seen = {}
+        score = 0.0
+        for start, end in positions:
+            keyword = text[start:end]
+            repeat = seen.get(keyword, 0) + 1
+            seen[keyword] = repeat
+            boundaries = _is_boundary(text, start - 1) + _is_boundary(text, end)
+            position = 1.0 + POSITION_BONUS * (1.0 - start / length)
+            score += BOUNDARY_WEIGHTS[boundaries] * position / repeat
+        scores[category_id] = score
+    return scores
+
+
+def select_categories(text, hits, categories_by_id, limit):
+    """Top-K категорий по оценке (при равенстве — по статическому priority)"""
+    scores = score_categories(text, hits)
+    ranked = sorted(
+        (categories_by_id[category_id] for category_id in scores if category_id in categories_by_id),
+        key=lambda cat: (scores[cat.category_id], cat.priority),
+        reverse=True,
+    )
+    return ranked[:max(limit, 1)]
@@ -0,0 +1,128 @@
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from collections import Counter
+
+# Тексты промптов длиннее порога (в байтах UTF-8) хранятся сжатыми (BLOB), короче — как есть (TEXT)
+PROMPT_COMPRESS_MIN_BYTES = int(os.environ.get('PROMPT_COMPRESS_MIN_BYTES', 256))
+PROMPT_COMPRESS_LEVEL = int(os.environ.get('PROMPT_COMPRESS_LEVEL', 6))
+# Размер общего словаря zlib (больше 32 КБ zlib не использует)
+ZDICT_SIZE = int(os.environ.get('ZDICT_SIZE', 32 * 1024))
+# Как часто проверять, не обучен ли новый словарь
+ZDICT_CHECK_INTERVAL = float(os.environ.get('ZDICT_CHECK_INTERVAL', 60))
+
+# Формат сжатого значения: первый байт — схема
+_RAW = b'\x01'        # raw deflate без словаря
+_WITH_DICT = b'\x02'  # raw deflate со словарём, далее 4 байта id словаря
+_DICT_ID = struct.Struct('<I')
+
+_dictionaries = {}    # id -> байты словаря
+_active_id = None
+_active_checked = 0.0
+_lock = threading.Lock()
+
+
+def _read_dictionaries(query, params=()):
+    # Отдельное короткое соединение: функция вызывается и изнутри SQL (decompress),
+    # где брать соединение из пула нельзя
+    from database import DB_NAME
+    conn = sqlite3.connect(DB_NAME)
+    try:
+        return conn.execute(query, params).fetchall()
+    except sqlite3.OperationalError:
+        return []  # таблицы ещё нет (до init_db)
+    finally:
+        conn.close()
+
+
+def _dictionary(dict_id):
+    zdict = _dictionaries.get(dict_id)
+    if zdict is None:
+        rows = _read_dictionaries("SELECT zdict FROM compression_dictionaries WHERE id = ?", (dict_id,))
+        if not rows:
+            raise ValueError(f"Нет словаря сжатия {dict_id}")
+        zdict = _dictionaries[dict_id] = rows[0][0]
+    return zdict
+
+
+def active_dictionary():
+    """(id, байты) последнего обученного словаря или (None, None)"""
+    global _active_id, _active_checked
+    now = time.monotonic()
+    if now - _active_checked >= ZDICT_CHECK_INTERVAL:
+        with _lock:
+            if now - _active_checked >= ZDICT_CHECK_INTERVAL:
+                rows = _read_dictionaries("SELECT id, zdict FROM compression_dictionaries ORDER BY id DESC LIMIT 1")
+                if rows:
+                    _active_id = rows[0][0]
+                    _dictionaries[_active_id] = rows[0][1]
+                _active_checked = now
+    if _active_id is None:
+        return None, None
+    return _active_id, _dictionaries[_active_id]
+
+
+def encode_text(text, min_bytes=PROMPT_COMPRESS_MIN_BYTES):
+    """Значение для записи в БД: сжатый BLOB, если это даёт выигрыш, иначе исходная строка"""
+    if not isinstance(text, str):
+        return text
+    raw = text.encode('utf-8')
+    if len(raw) < min_bytes:
+        return text
+    dict_id, zdict = active_dictionary()
+    if zdict is not None:
+        compressor = zlib.compressobj(PROMPT_COMPRESS_LEVEL, zlib.DEFLATED, -15, zdict=zdict)
+        header = _WITH_DICT + _DICT_ID.pack(dict_id)
+    else:
+        compressor = zlib.compressobj(PROMPT_COMPRESS_LEVEL, zlib.DEFLATED, -15)
+        header = _RAW
+    packed = header + compressor.compress(raw) + compressor.flush()
+    return packed if len(packed) < len(raw) else text
+
+
+def decode_text(value):
+    """Обратное к encode_text: строки возвращаются как есть, BLOB распаковываются"""
+    if value is None or isinstance(value, str):
+        return value
+    value = bytes(value)
+    scheme = value[:1]
+    if scheme == _RAW:
+        return zlib.decompress(value[1:], -15).decode('utf-8')
+    if scheme == _WITH_DICT:
+        (dict_id,) = _DICT_ID.unpack_from(value, 1)
+        decompressor = zlib.decompressobj(-15, zdict=_dictionary(dict_id))
+        return (decompressor.decompress(value[1 + _DICT_ID.size:]) + decompressor.flush()).decode('utf-8')
+    raise ValueError("Неизвестный формат сжатого текста")
+
+
+def train_dictionary(samples, size=ZDICT_SIZE):
+    """
+    Строит словарь zlib из образцов текстов: частые слова и фразы до 4 слов,
+    отобранные по числу сэкономленных байт. Самые полезные фразы идут в конец
+    словаря — на них deflate ссылается короче всего.
+    """
+    counts = Counter()
+    for text in samples:
+        words = text.split()
+        for n in (1, 2, 3, 4):
+            for i in range(len(words) - n + 1):
+                counts[' '.join(words[i:i + n])] += 1
+
+    scored = sorted(
+        ((count * len(phrase.encode('utf-8')), phrase) for phrase, count in counts.items() if count > 1),
+        reverse=True,
+    )
+    chosen = []
+    total = 0
+    for _, phrase in scored:
+        encoded = phrase.encode('utf-8') + b' '
+        if total + len(encoded) > size:
+            continue
+        chosen.append(encoded)
+        total += len(encoded)
+        if total >= size:
+            break
+    return b''.join(reversed(chosen))
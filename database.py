@@ -1,15 +1,126 @@
 import sqlite3
 import json
 import os
+import queue
+import threading
+from contextlib import contextmanager
 
 DB_NAME = "database.db"
 
-def get_db_connection():
-    """Возвращает соединение с БД (с row_factory для удобства)"""
-    conn = sqlite3.connect(DB_NAME)
+# Настройки пула соединений
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', 5))
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 16384))
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))
+
+# Архив старых промптов: пусто — таблица в основной БД, иначе путь к отдельному файлу БД
+PROMPT_ARCHIVE_DB = os.environ.get('PROMPT_ARCHIVE_DB', '')
+_ARCHIVE_SCHEMA = 'archive.' if PROMPT_ARCHIVE_DB else ''
+ARCHIVE_TABLE = f'{_ARCHIVE_SCHEMA}saved_prompts_archive'
+
+# Таблицы словаря: любое изменение в них увеличивает номер поколения словаря
+DICTIONARY_TABLES = ('connectors', 'model_rules', 'categories', 'category_localized', 'category_keywords')
+
+def _connect():
+    """Открывает новое соединение, настроенное на конкурентное чтение (WAL)"""
+    conn = sqlite3.connect(DB_NAME, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}")
+    # Тексты промптов могут храниться сжатыми (см. compression); decompress нужна
+    # представлению saved_prompts_text, из которого поиск берёт сниппеты.
+    # Запись в saved_prompts от неё не зависит
+    from compression import decode_text
+    conn.create_function('decompress', 1, decode_text, deterministic=True)
+    if PROMPT_ARCHIVE_DB:
+        conn.execute("ATTACH DATABASE ? AS archive", (PROMPT_ARCHIVE_DB,))
+        conn.execute("PRAGMA archive.journal_mode=WAL")
     return conn
 
+class ConnectionPool:
+    """
+    Потокобезопасный пул заранее открытых соединений.
+    Не больше size соединений одновременно выдано потокам; остальные ждут
+    до timeout секунд, после чего получают sqlite3.OperationalError.
+    """
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError("Пул соединений с БД исчерпан")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return _connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+        except sqlite3.Error:
+            # Сломанное соединение не возвращаем в пул
+            conn.close()
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    """Возвращает пул текущего процесса (после fork воркера gunicorn создаётся новый)"""
+    global _pool
+    pool = _pool
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT)
+            pool = _pool
+    return pool
+
+@contextmanager
+def get_db_connection():
+    """
+    Выдаёт соединение из пула (с row_factory для удобства).
+    При выходе из with транзакция фиксируется (или откатывается при исключении),
+    а соединение возвращается в пул.
+    """
+    pool = _get_pool()
+    conn = pool.acquire()
+    try:
+        with conn:
+            yield conn
+    finally:
+        pool.release(conn)
+
+def close_db_connections():
+    """Закрывает простаивающие соединения пула текущего процесса"""
+    if _pool is not None and _pool.pid == os.getpid():
+        _pool.close()
+
 def init_db():
     """Создаёт все таблицы, если их нет, и заполняет начальными данными"""
     with get_db_connection() as conn:
@@ -35,6 +146,162 @@ def init_db():
             )
         ''')
         
+        # Индексы для постраничной выдачи истории (по ключу created_at, id)
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_saved_prompts_user_created
+            ON saved_prompts (user_id, created_at DESC, id DESC)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_saved_prompts_user_type_created
+            ON saved_prompts (user_id, prompt_type, created_at DESC, id DESC)
+        ''')
+        
+        # --- Версия истории пользователя (растёт при любом изменении его saved_prompts) ---
+        # По ней строятся ETag для /api/history и /api/get_last_prompts
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_versions (
+                user_id INTEGER PRIMARY KEY,
+                version INTEGER NOT NULL
+            )
+        ''')
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_saved_prompts_version_{event.lower()}
+                AFTER {event} ON saved_prompts
+                BEGIN
+                    INSERT INTO user_versions (user_id, version) VALUES ({row}.user_id, 1)
+                    ON CONFLICT (user_id) DO UPDATE SET version = version + 1;
+                END
+            ''')
+        
+        # --- Последний промпт каждого типа для пользователя (поддерживается триггером) ---
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS last_prompts (
+                user_id INTEGER NOT NULL,
+                prompt_type TEXT NOT NULL,
+                prompt_id INTEGER NOT NULL,
+                input_text TEXT,
+                output_text TEXT,
+                PRIMARY KEY (user_id, prompt_type)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_saved_prompts_last
+            AFTER INSERT ON saved_prompts
+            WHEN NEW.prompt_type IN ('positive', 'negative')
+            BEGIN
+                INSERT INTO last_prompts (user_id, prompt_type, prompt_id, input_text, output_text)
+                VALUES (NEW.user_id, NEW.prompt_type, NEW.id, NEW.input_text, NEW.output_text)
+                ON CONFLICT (user_id, prompt_type) DO UPDATE SET
+                    prompt_id = excluded.prompt_id,
+                    input_text = excluded.input_text,
+                    output_text = excluded.output_text
+                WHERE excluded.prompt_id > last_prompts.prompt_id;
+            END
+        ''')
+        cursor.execute("SELECT COUNT(*) FROM last_prompts")
+        if cursor.fetchone()[0] == 0:
+            # Разовое заполнение по уже сохранённой истории
+            cursor.execute('''
+                INSERT INTO last_prompts (user_id, prompt_type, prompt_id, input_text, output_text)
+                SELECT s.user_id, s.prompt_type, s.id, s.input_text, s.output_text
+                FROM saved_prompts s
+                WHERE s.prompt_type IN ('positive', 'negative')
+                  AND s.id = (
+                      SELECT id FROM saved_prompts
+                      WHERE user_id = s.user_id AND prompt_type = s.prompt_type
+                      ORDER BY created_at DESC, id DESC LIMIT 1
+                  )
+            ''')
+        
+        # --- Архив старых промптов (тот же формат, id сохраняются) ---
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {ARCHIVE_TABLE} (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                prompt_type TEXT,
+                input_text TEXT,
+                output_text TEXT,
+                created_at TIMESTAMP
+            )
+        ''')
+        cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS {_ARCHIVE_SCHEMA}idx_saved_prompts_archive_user_created
+            ON saved_prompts_archive (user_id, created_at DESC, id DESC)
+        ''')
+        cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS {_ARCHIVE_SCHEMA}idx_saved_prompts_archive_user_type_created
+            ON saved_prompts_archive (user_id, prompt_type, created_at DESC, id DESC)
+        ''')
+        
+        # --- Словари для сжатия текстов промптов (см. compression) ---
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS compression_dictionaries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                zdict BLOB NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # --- Полнотекстовый индекс истории (FTS5) ---
+        # Содержимое берётся из представления с уже распакованными текстами.
+        # user_id индексируется как отдельная колонка: условие по нему отсекает чужие записи
+        # (списки вхождений слов запроса при этом всё равно читаются по всем пользователям)
+        cursor.execute('''
+            CREATE VIEW IF NOT EXISTS saved_prompts_text AS
+            SELECT id, user_id, decompress(input_text) AS input_text, decompress(output_text) AS output_text
+            FROM saved_prompts
+        ''')
+        fts = cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'saved_prompts_fts'"
+        ).fetchone()
+        if fts and "content='saved_prompts_text'" not in fts[0]:
+            # Индекс старого формата (содержимое прямо из saved_prompts) пересоздаётся
+            cursor.execute("DROP TABLE saved_prompts_fts")
+            fts = None
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS saved_prompts_fts USING fts5(
+                user_id, input_text, output_text,
+                content='saved_prompts_text', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            )
+        ''')
+        # Индекс ведёт prompt_store (см. index_prompts): триггеры прошлых версий
+        # распаковывали тексты функцией decompress, и без неё saved_prompts
+        # нельзя было изменить из обычного соединения
+        for event in ('insert', 'delete', 'update'):
+            cursor.execute(f"DROP TRIGGER IF EXISTS trg_saved_prompts_fts_{event}")
+        if not fts:
+            # Разовая индексация уже сохранённой истории
+            cursor.execute("INSERT INTO saved_prompts_fts (saved_prompts_fts) VALUES ('rebuild')")
+        
+        # --- Общий для воркеров кэш ответов YandexGPT ---
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ai_response_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_ai_response_cache_expires ON ai_response_cache (expires_at)")
+        
+        # --- Ответы YandexGPT для повторного использования на похожих запросах (см. near_duplicates) ---
+        similar_columns = {row[1] for row in cursor.execute("PRAGMA table_info(ai_similar_prompts)")}
+        if 'words' in similar_columns:
+            # Прошлая версия хранила слова без порядка; это кэш, записи просто сбрасываются
+            cursor.execute("DROP TABLE ai_similar_prompts")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ai_similar_prompts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                scope TEXT NOT NULL,          -- хэш (модель, model_key, инструкции)
+                tokens TEXT NOT NULL,         -- нормализованные слова задачи по порядку через пробел
+                signature BLOB NOT NULL,      -- MinHash-подпись
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_ai_similar_prompts_created ON ai_similar_prompts (created_at)")
+        
         # --- Новые таблицы для словаря ---
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS connectors (
@@ -58,9 +325,18 @@ def init_db():
                 group_name TEXT NOT NULL,
                 category_id TEXT UNIQUE NOT NULL,
                 priority INTEGER NOT NULL,
-                keywords TEXT NOT NULL   -- JSON-массив
+                keywords TEXT NOT NULL DEFAULT '[]'   -- устарело: ключевые слова лежат в category_keywords
             )
         ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS category_keywords (
+                keyword TEXT NOT NULL,       -- в нижнем регистре
+                category_id TEXT NOT NULL,
+                PRIMARY KEY (keyword, category_id),
+                FOREIGN KEY (category_id) REFERENCES categories(category_id)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_category_keywords_category ON category_keywords (category_id)")
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS category_localized (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -75,13 +351,73 @@ def init_db():
             )
         ''')
         
-        # Если таблицы пустые – загружаем данные из резервного словаря (бывшего dictionary.js)
-        cursor.execute("SELECT COUNT(*) FROM connectors")
-        if cursor.fetchone()[0] == 0:
+        # --- Номер поколения словаря (поддерживается триггерами) ---
+        # seeded — резервный словарь уже загружался; после этого пустые таблицы
+        # (например, после импорта с --replace) заново не заполняются
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS dictionary_meta (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                generation INTEGER NOT NULL,
+                seeded INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        meta_columns = {row[1] for row in cursor.execute("PRAGMA table_info(dictionary_meta)")}
+        if 'seeded' not in meta_columns:
+            # Таблица из прошлой версии: её создавал тот же init_db, что загружал словарь
+            cursor.execute("ALTER TABLE dictionary_meta ADD COLUMN seeded INTEGER NOT NULL DEFAULT 1")
+        cursor.execute("INSERT OR IGNORE INTO dictionary_meta (id, generation) VALUES (1, 0)")
+        for table in DICTIONARY_TABLES:
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_generation
+                    AFTER {event} ON {table}
+                    BEGIN
+                        UPDATE dictionary_meta SET generation = generation + 1 WHERE id = 1;
+                    END
+                ''')
+        
+        # Перенос ключевых слов из JSON-колонки categories.keywords в category_keywords
+        _migrate_category_keywords(cursor)
+        
+        # При первом запуске загружаем данные из резервного словаря (бывшего dictionary.js)
+        cursor.execute("SELECT seeded FROM dictionary_meta WHERE id = 1")
+        if not cursor.fetchone()[0]:
             _load_initial_dictionary_data(cursor)
+            cursor.execute("UPDATE dictionary_meta SET seeded = 1 WHERE id = 1")
         
         conn.commit()
 
+def get_dictionary_generation(conn):
+    """Возвращает текущий номер поколения словаря"""
+    row = conn.execute("SELECT generation FROM dictionary_meta WHERE id = 1").fetchone()
+    return row[0] if row else 0
+
+def _migrate_category_keywords(cursor):
+    """
+    Разовая миграция: ключевые слова из JSON-массивов categories.keywords
+    переносятся в category_keywords, а сама колонка очищается, чтобы
+    повторный запуск ничего не делал.
+    """
+    rows = cursor.execute("SELECT category_id, keywords FROM categories WHERE keywords != '[]'").fetchall()
+    if not rows:
+        return
+    keyword_rows = []
+    for category_id, keywords in rows:
+        try:
+            keywords = json.loads(keywords)
+        except ValueError:
+            print(f"Категория {category_id}: не удалось разобрать keywords, пропускаем")
+            continue
+        keyword_rows.extend(
+            (str(kw).strip().lower(), category_id) for kw in keywords if str(kw).strip()
+        )
+    cursor.executemany(
+        "INSERT OR IGNORE INTO category_keywords (keyword, category_id) VALUES (?, ?)",
+        keyword_rows
+    )
+    cursor.execute("UPDATE categories SET keywords = '[]' WHERE keywords != '[]'")
+    print(f"Ключевые слова перенесены в category_keywords: {len(keyword_rows)}")
+
 def _load_initial_dictionary_data(cursor):
     # Коннекторы
     connectors_data = [
@@ -97,7 +433,7 @@ def _load_initial_dictionary_data(cursor):
         ('en', 'ending', 'Provide the output using')
     ]
     cursor.executemany(
-        "INSERT INTO connectors (locale, key_name, phrase) VALUES (?, ?, ?)",
+        "INSERT OR IGNORE INTO connectors (locale, key_name, phrase) VALUES (?, ?, ?)",
         connectors_data
     )
     
@@ -110,22 +446,26 @@ def _load_initial_dictionary_data(cursor):
         ('default', 'Будь точным и следуй заданным инструкциям.')
     ]
     cursor.executemany(
-        "INSERT INTO model_rules (model_key, rule_text) VALUES (?, ?)",
+        "INSERT OR IGNORE INTO model_rules (model_key, rule_text) VALUES (?, ?)",
         models_rules_data
     )
     
     # Категории и локализации (сжатый пример – полную версию можно взять из старого dictionary.js)
     categories_data = [
-        ('coding', 'gamedev', 50, '["игра","змейка","тетрис","game","unity","unreal","pygame","canvas","движок","snake","геймдев"]'),
-        ('coding', 'backend', 40, '["бэкенд","сервер","api","sql","backend","database","node","python","питон","php","go","база данных"]'),
-        ('coding', 'frontend', 35, '["фронтенд","react","vue","frontend","html","css","интерфейс","ui","ux","верстка"]'),
-        ('creative', 'brainstorm', 30, '["идеи","придумай","креатив","ideas","brainstorm","концепт","генерировать"]'),
-        ('creative', 'marketing', 25, '["маркетинг","продажи","бренд","реклама","marketing","ads","seo","копирайтинг"]'),
-        ('general', 'improve', 1, '["улучши","перепиши","исправь","доработай","improve","rewrite","refine"]')
+        ('coding', 'gamedev', 50, ["игра","змейка","тетрис","game","unity","unreal","pygame","canvas","движок","snake","геймдев"]),
+        ('coding', 'backend', 40, ["бэкенд","сервер","api","sql","backend","database","node","python","питон","php","go","база данных"]),
+        ('coding', 'frontend', 35, ["фронтенд","react","vue","frontend","html","css","интерфейс","ui","ux","верстка"]),
+        ('creative', 'brainstorm', 30, ["идеи","придумай","креатив","ideas","brainstorm","концепт","генерировать"]),
+        ('creative', 'marketing', 25, ["маркетинг","продажи","бренд","реклама","marketing","ads","seo","копирайтинг"]),
+        ('general', 'improve', 1, ["улучши","перепиши","исправь","доработай","improve","rewrite","refine"])
     ]
     cursor.executemany(
-        "INSERT INTO categories (group_name, category_id, priority, keywords) VALUES (?, ?, ?, ?)",
-        categories_data
+        "INSERT OR IGNORE INTO categories (group_name, category_id, priority, keywords) VALUES (?, ?, ?, '[]')",
+        [(group, category_id, priority) for group, category_id, priority, _ in categories_data]
+    )
+    cursor.executemany(
+        "INSERT OR IGNORE INTO category_keywords (keyword, category_id) VALUES (?, ?)",
+        [(kw, category_id) for _, category_id, _, keywords in categories_data for kw in keywords]
     )
     
     # Локализованные данные (только ru и en для gamedev, остальные аналогично – для brevity показываю несколько)
@@ -148,6 +488,6 @@ def _load_initial_dictionary_data(cursor):
         # можно добавить en версии аналогично...
     ]
     cursor.executemany(
-        "INSERT INTO category_localized (category_id, locale, role, pos_phrases, neg_phrases, format_phrases) VALUES (?, ?, ?, ?, ?, ?)",
+        "INSERT OR IGNORE INTO category_localized (category_id, locale, role, pos_phrases, neg_phrases, format_phrases) VALUES (?, ?, ?, ?, ?, ?)",
         loc_data
     )
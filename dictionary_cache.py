@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+from database import get_db_connection, get_dictionary_generation
+from keyword_matcher import KeywordMatcher
+from metrics import span
+
+# Как часто (в секундах) сверяться с номером поколения словаря в БД.
+# Между проверками запросы обслуживаются целиком из памяти.
+DICTIONARY_CHECK_INTERVAL = float(os.environ.get('DICTIONARY_CHECK_INTERVAL', 5))
+
+# Категория с уже разобранными ключевыми словами и фразами
+Category = namedtuple('Category', [
+    'category_id', 'priority', 'keywords',
+    'role', 'pos_phrases', 'neg_phrases', 'format_phrases',
+])
+
+# Снимок словаря для одной локали (matcher — автомат по ключевым словам всех категорий)
+DictionarySnapshot = namedtuple('DictionarySnapshot', [
+    'generation', 'locale', 'connectors', 'model_rules', 'categories', 'categories_by_id', 'matcher',
+])
+
+_lock = threading.Lock()
+# Снимки известных локалей; все прочие (локаль приходит от клиента) делят
+# один снимок без локализованных данных под ключом None, так что словарь
+# снимков ограничен числом локалей в БД
+_snapshots = {}
+_locales = frozenset()
+# Блокировки сборки по ключу снимка: снимок одной локали собирает один поток
+_build_locks = {}
+_generation = None
+_last_check = 0.0
+
+
+def _load_snapshot(conn, locale, generation):
+    """Читает словарь локали из БД и разбирает все JSON-поля один раз"""
+    connectors = {
+        row['key_name']: row['phrase']
+        for row in conn.execute("SELECT key_name, phrase FROM connectors WHERE locale = ?", (locale,))
+    }
+    model_rules = {
+        row['model_key']: row['rule_text']
+        for row in conn.execute("SELECT model_key, rule_text FROM model_rules")
+    }
+    # Ключевые слова только тех категорий, что переведены на эту локаль
+    keywords = {}
+    for keyword, category_id in conn.execute('''
+        SELECT ck.keyword, ck.category_id
+        FROM category_keywords ck
+        JOIN category_localized cl ON cl.category_id = ck.category_id
+        WHERE cl.locale = ?
+    ''', (locale,)):
+        keywords.setdefault(category_id, []).append(keyword)
+    rows = conn.execute('''
+        SELECT c.category_id, c.priority,
+               cl.role, cl.pos_phrases, cl.neg_phrases, cl.format_phrases
+        FROM categories c
+        JOIN category_localized cl ON c.category_id = cl.category_id
+        WHERE cl.locale = ?
+    ''', (locale,)).fetchall()
+    categories = tuple(
+        Category(
+            category_id=row['category_id'],
+            priority=row['priority'],
+            keywords=tuple(keywords.get(row['category_id'], ())),
+            role=row['role'],
+            pos_phrases=tuple(json.loads(row['pos_phrases'])),
+            neg_phrases=tuple(json.loads(row['neg_phrases'])),
+            format_phrases=tuple(json.loads(row['format_phrases'])),
+        )
+        for row in rows
+    )
+    matcher = KeywordMatcher(
+        (kw, cat.category_id) for cat in categories for kw in cat.keywords
+    )
+    categories_by_id = {cat.category_id: cat for cat in categories}
+    return DictionarySnapshot(generation, locale, connectors, model_rules, categories, categories_by_id, matcher)
+
+
+def _load_locales(conn):
+    return frozenset(
+        row[0] for row in conn.execute(
+            "SELECT locale FROM connectors UNION SELECT locale FROM category_localized"
+        )
+    )
+
+
+def get_snapshot(locale):
+    """
+    Возвращает снимок словаря для локали.
+    Снимок пересобирается только когда в БД сменился номер поколения словаря.
+    Сборка идёт вне общей блокировки: пока собирается снимок одной локали,
+    запросы с другими локалями обслуживаются; ждут только запросы той же локали.
+    """
+    global _generation, _last_check, _locales
+    now = time.monotonic()
+    snapshot = _snapshots.get(locale if locale in _locales else None)
+    if snapshot is not None and now - _last_check < DICTIONARY_CHECK_INTERVAL:
+        return snapshot
+
+    with _lock:
+        if time.monotonic() - _last_check >= DICTIONARY_CHECK_INTERVAL or _generation is None:
+            with get_db_connection() as conn:
+                generation = get_dictionary_generation(conn)
+                if generation != _generation:
+                    _snapshots.clear()
+                    _locales = _load_locales(conn)
+                    _generation = generation
+            _last_check = time.monotonic()
+        key = locale if locale in _locales else None
+        snapshot = _snapshots.get(key)
+        if snapshot is not None:
+            return snapshot
+        generation = _generation
+        build_lock = _build_locks.setdefault(key, threading.Lock())
+
+    with build_lock:
+        # Пока ждали, снимок мог собрать другой поток
+        snapshot = _snapshots.get(key)
+        if snapshot is not None and snapshot.generation == generation:
+            return snapshot
+        with get_db_connection() as conn, span("dictionary_load"):
+            snapshot = _load_snapshot(conn, key, generation)
+        with _lock:
+            if generation == _generation:
+                _snapshots[key] = snapshot
+        return snapshot
+
+
+def invalidate():
+    """Сбрасывает все снимки (следующий запрос перечитает словарь из БД)"""
+    global _generation, _locales
+    with _lock:
+        _snapshots.clear()
+        _locales = frozenset()
+        _generation = None
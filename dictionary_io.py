@@ -0,0 +1,341 @@
+# Импорт и экспорт словаря: коннекторы, правила моделей, категории,
+# их локализации и ключевые слова.
+#
+#   python dictionary_io.py import dictionary.jsonl [--replace] [--dry-run]
+#   python dictionary_io.py export dictionary.json
+#
+# Форматы (определяются по расширению или --format):
+#   json  — документ {"connectors": [...], "model_rules": [...], "categories": [...]},
+#           в категории можно вложить "keywords" и "localized";
+#   jsonl — по записи на строку, тип записи в поле "type"
+#           (connector, model_rule, category, localized, keyword);
+#   csv   — только ключевые слова, колонки category_id и keyword.
+# Импорт идёт одной транзакцией пачками по batch_size строк; при ошибках
+# проверки ничего не записывается.
+import argparse
+import csv
+import json
+import os
+import sys
+
+from database import get_db_connection, init_db
+
+DICTIONARY_IMPORT_BATCH_SIZE = int(os.environ.get('DICTIONARY_IMPORT_BATCH_SIZE', 5000))
+DICTIONARY_MAX_KEYWORD_LENGTH = int(os.environ.get('DICTIONARY_MAX_KEYWORD_LENGTH', 200))
+# После скольких ошибок проверки импорт прекращается
+DICTIONARY_MAX_ERRORS = 20
+
+FORMATS = ('json', 'jsonl', 'csv')
+PHRASE_FIELDS = ('pos_phrases', 'neg_phrases', 'format_phrases')
+
+_UPSERTS = {
+    'connector': '''
+        INSERT INTO connectors (locale, key_name, phrase) VALUES (?, ?, ?)
+        ON CONFLICT (locale, key_name) DO UPDATE SET phrase = excluded.phrase
+    ''',
+    'model_rule': '''
+        INSERT INTO model_rules (model_key, rule_text) VALUES (?, ?)
+        ON CONFLICT (model_key) DO UPDATE SET rule_text = excluded.rule_text
+    ''',
+    'category': '''
+        INSERT INTO categories (category_id, group_name, priority, keywords) VALUES (?, ?, ?, '[]')
+        ON CONFLICT (category_id) DO UPDATE SET group_name = excluded.group_name, priority = excluded.priority
+    ''',
+    'localized': '''
+        INSERT INTO category_localized (category_id, locale, role, pos_phrases, neg_phrases, format_phrases)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (category_id, locale) DO UPDATE SET
+            role = excluded.role,
+            pos_phrases = excluded.pos_phrases,
+            neg_phrases = excluded.neg_phrases,
+            format_phrases = excluded.format_phrases
+    ''',
+    'keyword': "INSERT OR IGNORE INTO category_keywords (keyword, category_id) VALUES (?, ?)",
+}
+
+# Таблицы в порядке очистки при --replace
+_REPLACE_ORDER = ('category_keywords', 'category_localized', 'categories', 'model_rules', 'connectors')
+
+
+class DictionaryImportError(ValueError):
+    """Файл словаря не прошёл проверку; errors — список сообщений"""
+
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+def _detect_format(path, fmt):
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат словаря: {fmt or path}")
+    return fmt
+
+
+def _expand_category(record):
+    """Категория с вложенными keywords/localized раскладывается на отдельные записи"""
+    category_id = record.get('category_id')
+    yield {key: value for key, value in record.items() if key not in ('keywords', 'localized')}
+    keywords = record.get('keywords') or []
+    if not isinstance(keywords, list):
+        yield ValueError("поле keywords должно быть списком")
+        keywords = []
+    for keyword in keywords:
+        yield {'type': 'keyword', 'category_id': category_id, 'keyword': keyword}
+    localized = record.get('localized') or []
+    if isinstance(localized, dict):
+        # {"ru": {...}, "en": {...}}
+        localized = [dict(value, locale=locale) if isinstance(value, dict) else value
+                     for locale, value in localized.items()]
+    if not isinstance(localized, list):
+        yield ValueError("поле localized должно быть списком")
+        localized = []
+    for item in localized:
+        yield dict(item, type='localized', category_id=category_id) if isinstance(item, dict) else item
+
+
+def _read_records(path, fmt):
+    """Генерирует пары (место в файле, запись)"""
+    if fmt == 'csv':
+        with open(path, newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            missing = {'category_id', 'keyword'} - set(reader.fieldnames or ())
+            if missing:
+                raise DictionaryImportError([f"В CSV нет колонок: {', '.join(sorted(missing))}"])
+            for row in reader:
+                yield f"строка {reader.line_num}", {'type': 'keyword', **row}
+        return
+
+    if fmt == 'jsonl':
+        with open(path, encoding='utf-8') as f:
+            for line_num, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    yield f"строка {line_num}", e
+                    continue
+                if isinstance(record, dict) and record.get('type') == 'category':
+                    for item in _expand_category(record):
+                        yield f"строка {line_num}", item
+                else:
+                    yield f"строка {line_num}", record
+        return
+
+    # json: документ читается целиком, для очень больших словарей удобнее jsonl/csv
+    with open(path, encoding='utf-8') as f:
+        document = json.load(f)
+    if not isinstance(document, dict):
+        raise DictionaryImportError(["Ожидался JSON-объект с разделами словаря"])
+    sections = (('connectors', 'connector'), ('model_rules', 'model_rule'), ('categories', 'category'))
+    for section, record_type in sections:
+        for index, record in enumerate(document.get(section) or ()):
+            where = f"{section}[{index}]"
+            if not isinstance(record, dict):
+                yield where, record
+            elif record_type == 'category':
+                for item in _expand_category(dict(record, type=record_type)):
+                    yield where, item
+            else:
+                yield where, dict(record, type=record_type)
+
+
+def _text(record, field, required=True):
+    value = record.get(field)
+    if not isinstance(value, str) or (required and not value.strip()):
+        raise ValueError(f"поле {field} должно быть {'непустой ' if required else ''}строкой")
+    return value
+
+
+def _phrases(record, field):
+    value = record.get(field, [])
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise ValueError(f"поле {field} должно быть списком строк")
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _to_row(record):
+    """Проверяет запись и возвращает (тип, строка для вставки); при ошибке — ValueError"""
+    if not isinstance(record, dict):
+        raise ValueError("запись должна быть объектом")
+    record_type = record.get('type')
+    if record_type == 'keyword':
+        keyword = _text(record, 'keyword').strip().lower()
+        if len(keyword) > DICTIONARY_MAX_KEYWORD_LENGTH:
+            raise ValueError(f"ключевое слово длиннее {DICTIONARY_MAX_KEYWORD_LENGTH} символов")
+        return record_type, (keyword, _text(record, 'category_id'))
+    if record_type == 'category':
+        priority = record.get('priority')
+        if not isinstance(priority, int) or isinstance(priority, bool):
+            raise ValueError("поле priority должно быть целым числом")
+        return record_type, (_text(record, 'category_id'), _text(record, 'group_name'), priority)
+    if record_type == 'localized':
+        return record_type, (
+            _text(record, 'category_id'), _text(record, 'locale'), _text(record, 'role'),
+            *(_phrases(record, field) for field in PHRASE_FIELDS),
+        )
+    if record_type == 'connector':
+        return record_type, (_text(record, 'locale'), _text(record, 'key_name'), _text(record, 'phrase'))
+    if record_type == 'model_rule':
+        return record_type, (_text(record, 'model_key'), _text(record, 'rule_text'))
+    raise ValueError(f"неизвестный тип записи: {record_type!r}")
+
+
+def _check_references(conn):
+    """Ключевые слова и локализации должны ссылаться на существующие категории"""
+    errors = []
+    for table in ('category_keywords', 'category_localized'):
+        rows = conn.execute(f'''
+            SELECT DISTINCT t.category_id FROM {table} t
+            LEFT JOIN categories c ON c.category_id = t.category_id
+            WHERE c.category_id IS NULL
+            LIMIT {DICTIONARY_MAX_ERRORS}
+        ''').fetchall()
+        errors.extend(f"{table}: нет категории {row[0]!r}" for row in rows)
+    return errors
+
+
+class _DryRun(Exception):
+    pass
+
+
+def import_dictionary(path, fmt=None, replace=False, dry_run=False, batch_size=DICTIONARY_IMPORT_BATCH_SIZE):
+    """
+    Загружает словарь из файла одной транзакцией.
+    replace=True — предварительно очищает словарь, иначе записи добавляются
+    или обновляются по ключу. dry_run=True — только проверка, без записи.
+    Возвращает число записей по типам; при ошибках — DictionaryImportError.
+    """
+    fmt = _detect_format(path, fmt)
+    counts = dict.fromkeys(_UPSERTS, 0)
+    errors = []
+    batches = {record_type: [] for record_type in _UPSERTS}
+
+    def flush(conn, record_type):
+        rows = batches[record_type]
+        if rows:
+            conn.executemany(_UPSERTS[record_type], rows)
+            rows.clear()
+
+    init_db()
+    try:
+        with get_db_connection() as conn:
+            if replace:
+                for table in _REPLACE_ORDER:
+                    conn.execute(f"DELETE FROM {table}")
+            for where, record in _read_records(path, fmt):
+                try:
+                    if isinstance(record, Exception):
+                        raise ValueError(str(record))
+                    record_type, row = _to_row(record)
+                except ValueError as e:
+                    errors.append(f"{where}: {e}")
+                    if len(errors) >= DICTIONARY_MAX_ERRORS:
+                        break
+                    continue
+                if errors:
+                    continue  # после первой ошибки только проверяем остаток файла
+                batches[record_type].append(row)
+                counts[record_type] += 1
+                if len(batches[record_type]) >= batch_size:
+                    flush(conn, record_type)
+            if not errors:
+                for record_type in batches:
+                    flush(conn, record_type)
+                errors.extend(_check_references(conn))
+            if errors:
+                raise DictionaryImportError(errors)
+            if dry_run:
+                raise _DryRun()
+    except _DryRun:
+        pass
+    return counts
+
+
+def _iter_export(conn):
+    """Записи словаря в формате jsonl (ключевые слова отдельными записями)"""
+    for row in conn.execute("SELECT locale, key_name, phrase FROM connectors ORDER BY locale, key_name"):
+        yield {'type': 'connector', **dict(row)}
+    for row in conn.execute("SELECT model_key, rule_text FROM model_rules ORDER BY model_key"):
+        yield {'type': 'model_rule', **dict(row)}
+    for row in conn.execute("SELECT category_id, group_name, priority FROM categories ORDER BY category_id"):
+        yield {'type': 'category', **dict(row)}
+    for row in conn.execute(f'''
+        SELECT category_id, locale, role, {', '.join(PHRASE_FIELDS)}
+        FROM category_localized ORDER BY category_id, locale
+    '''):
+        record = {'type': 'localized', **dict(row)}
+        for field in PHRASE_FIELDS:
+            record[field] = json.loads(record[field])
+        yield record
+    for row in conn.execute("SELECT category_id, keyword FROM category_keywords ORDER BY category_id, keyword"):
+        yield {'type': 'keyword', **dict(row)}
+
+
+def export_dictionary(path, fmt=None):
+    """Выгружает словарь в файл; возвращает число записей"""
+    fmt = _detect_format(path, fmt)
+    count = 0
+    init_db()
+    with get_db_connection() as conn, open(path, 'w', newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(('category_id', 'keyword'))
+            for row in conn.execute("SELECT category_id, keyword FROM category_keywords ORDER BY category_id, keyword"):
+                writer.writerow(tuple(row))
+                count += 1
+        elif fmt == 'jsonl':
+            for record in _iter_export(conn):
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                count += 1
+        else:
+            document = {'connectors': [], 'model_rules': [], 'categories': []}
+            categories = {}
+            for record in _iter_export(conn):
+                record_type = record.pop('type')
+                count += 1
+                if record_type == 'connector':
+                    document['connectors'].append(record)
+                elif record_type == 'model_rule':
+                    document['model_rules'].append(record)
+                elif record_type == 'category':
+                    record.update(keywords=[], localized=[])
+                    categories[record['category_id']] = record
+                    document['categories'].append(record)
+                elif record['category_id'] in categories:
+                    category = categories[record.pop('category_id')]
+                    if record_type == 'keyword':
+                        category['keywords'].append(record['keyword'])
+                    else:
+                        category['localized'].append(record)
+            json.dump(document, f, ensure_ascii=False, indent=2)
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Импорт и экспорт словаря промптов")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help="загрузить словарь из файла")
+    import_parser.add_argument('path')
+    import_parser.add_argument('--format', choices=FORMATS)
+    import_parser.add_argument('--replace', action='store_true', help="заменить словарь целиком")
+    import_parser.add_argument('--dry-run', action='store_true', help="только проверить файл")
+    import_parser.add_argument('--batch-size', type=int, default=DICTIONARY_IMPORT_BATCH_SIZE)
+    export_parser = subparsers.add_parser('export', help="выгрузить словарь в файл")
+    export_parser.add_argument('path')
+    export_parser.add_argument('--format', choices=FORMATS)
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        try:
+            counts = import_dictionary(args.path, args.format, args.replace, args.dry_run, args.batch_size)
+        except DictionaryImportError as e:
+            print("Импорт отменён, ошибки в файле:", file=sys.stderr)
+            for error in e.errors:
+                print(f"  {error}", file=sys.stderr)
+            sys.exit(1)
+        summary = ', '.join(f"{record_type}: {count}" for record_type, count in counts.items())
+        print(f"{'Проверено' if args.dry_run else 'Загружено'} — {summary}")
+    else:
+        print(f"Выгружено записей: {export_dictionary(args.path, args.format)}")
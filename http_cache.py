@@ -0,0 +1,72 @@
+# Условные запросы (ETag / If-None-Match) и сжатие ответов для эндпоинтов чтения.
+# ETag строится по версии истории пользователя (user_versions), поэтому ответ 304
+# отдаётся без чтения saved_prompts. Сжатие — gzip или brotli (если установлен
+# пакет brotli) по Accept-Encoding; к ETag сжатого ответа добавляется суффикс
+# кодировки, чтобы разные представления не имели одинаковый сильный ETag.
+import gzip
+import hashlib
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# JSON-ответы меньше порога (в байтах) не сжимаются
+RESPONSE_COMPRESS_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESS_MIN_BYTES', 1024))
+RESPONSE_GZIP_LEVEL = int(os.environ.get('RESPONSE_GZIP_LEVEL', 6))
+RESPONSE_BROTLI_QUALITY = int(os.environ.get('RESPONSE_BROTLI_QUALITY', 5))
+
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def make_etag(version, *params):
+    """Сильный ETag (без кавычек): версия данных и хэш параметров, от которых зависит ответ"""
+    digest = hashlib.blake2b(repr(params).encode('utf-8'), digest_size=8).hexdigest()
+    return f"{version}-{digest}"
+
+
+def matching_etag(etag, if_none_match):
+    """
+    Тег из If-None-Match (request.if_none_match), совпадающий с etag с точностью
+    до суффикса кодировки, или None. Возвращается именно присланный тег: клиент хранит то представление,
+    которое получил.
+    """
+    # If-None-Match сравнивается слабым сравнением, поэтому W/-теги тоже подходят
+    if if_none_match.star_tag:
+        return etag
+    for tag in if_none_match.as_set(include_weak=True):
+        base = tag
+        for encoding in ENCODINGS:
+            if tag.endswith('-' + encoding):
+                base = tag[:-len(encoding) - 1]
+                break
+        if base == etag:
+            return tag
+    return None
+
+
+def _compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=RESPONSE_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=RESPONSE_GZIP_LEVEL)
+
+
+def compress_response(response, accept_encodings):
+    """Сжимает крупный JSON-ответ кодировкой, выбранной по Accept-Encoding клиента"""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers):
+        return response
+    data = response.get_data()
+    if len(data) < RESPONSE_COMPRESS_MIN_BYTES:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accept_encodings.best_match(ENCODINGS)
+    if encoding is None:
+        return response
+    response.set_data(_compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
@@ -0,0 +1,158 @@
+from array import array
+
+# Сколько первых (самых мелких) узлов бора хранят переходы в словарях: по ним
+# проходит большая часть переходов, а памяти они берут не больше мегабайта.
+# Словари из нескольких десятков слов целиком укладываются в этот предел.
+DENSE_NODES = 4096
+
+
+class KeywordMatcher:
+    """
+    Автомат Ахо-Корасик для поиска сразу всех ключевых слов словаря.
+    Собирается один раз на снимок словаря, а текст проходится за один проход
+    независимо от числа категорий и ключевых слов.
+
+    Бор хранится плоско, без словаря на каждый узел (на 100k ключевых слов
+    это сотни мегабайт на воркер). Узлы пронумерованы обходом в ширину,
+    поэтому дети узла идут подряд. В строке _labels символ i — это метка
+    ребра в узел i + 1, а рёбра узла n занимают _labels[_first[n]:_first[n + 1]].
+    Переход по символу — str.find по этому отрезку; у первых DENSE_NODES
+    узлов переходы дополнительно лежат в словарях.
+    """
+
+    def __init__(self, keywords):
+        """keywords — итерируемое пар (ключевое слово, метка категории)"""
+        tags_by_keyword = {}
+        for keyword, tag in keywords:
+            keyword = keyword.lower()
+            if not keyword:
+                continue
+            tags = tags_by_keyword.setdefault(keyword, [])
+            if tag not in tags:
+                tags.append(tag)
+        self.size = sum(len(tags) for tags in tags_by_keyword.values())
+
+        # Бор строится по отсортированным словам: поддерево узла — непрерывный
+        # отрезок списка, а его дети — группы этого отрезка с одной буквой
+        # на глубине узла (слово, равное префиксу, стоит в группе первым)
+        words = sorted(tags_by_keyword)
+        labels = []
+        first = array('I', [0])
+        goto = []                      # переходы первых DENSE_NODES узлов
+        self._out = {}                 # узел -> (длина слова, метки)
+        level = [(0, len(words))]      # отрезки слов узлов текущей глубины
+        depth = 0
+        node = 0
+        while level:
+            next_level = []
+            for lo, hi in level:
+                if lo < hi and len(words[lo]) == depth:
+                    self._out[node] = (depth, tuple(tags_by_keyword[words[lo]]))
+                    lo += 1
+                children = {}
+                while lo < hi:
+                    ch = words[lo][depth]
+                    end = lo + 1
+                    while end < hi and words[end][depth] == ch:
+                        end += 1
+                    labels.append(ch)
+                    children[ch] = len(labels)
+                    next_level.append((lo, end))
+                    lo = end
+                if node < DENSE_NODES:
+                    goto.append(children)
+                first.append(len(labels))
+                node += 1
+            level = next_level
+            depth += 1
+        self._labels = labels = ''.join(labels)
+        self._first = first
+
+        self._goto = goto
+        self._dense = dense = len(goto)
+        root = goto[0]
+
+        # Суффиксные ссылки и ссылки на ближайший по ним узел со словом
+        # считаются в порядке номеров узлов, то есть обходом в ширину
+        count = len(first) - 1
+        fail = array('I', bytes(4 * count))
+        link = array('I', bytes(4 * count))
+        emits = bytearray(count)       # 1 — в узле или по его суффиксным ссылкам заканчивается слово
+        out = self._out
+        for parent in range(1, count):
+            start, end = first[parent], first[parent + 1]
+            if start == end:
+                continue
+            parent_fail = fail[parent]
+            for child in range(start + 1, end + 1):
+                ch = labels[child - 1]
+                f = parent_fail
+                while f:
+                    if f < dense:
+                        target = goto[f].get(ch)
+                        if target:
+                            break
+                    else:
+                        index = labels.find(ch, first[f], first[f + 1])
+                        if index >= 0:
+                            target = index + 1
+                            break
+                    f = fail[f]
+                else:
+                    target = root.get(ch, 0)
+                fail[child] = target
+                if target in out:
+                    link[child] = target
+                    emits[child] = 1
+                elif link[target]:
+                    link[child] = link[target]
+                    emits[child] = 1
+        for node in out:
+            emits[node] = 1
+        self._fail = fail
+        self._link = link
+        self._emits = emits
+
+    def iter_matches(self, text):
+        """Генерирует (начало, конец, метка) для каждого вхождения ключевого слова в text"""
+        labels, first, fail, link, out = self._labels, self._first, self._fail, self._link, self._out
+        goto, dense, emits = self._goto, self._dense, self._emits
+        root = goto[0]
+        node = 0
+        for i, ch in enumerate(text):
+            while node:
+                if node < dense:
+                    child = goto[node].get(ch)
+                    if child:
+                        node = child
+                        break
+                else:
+                    index = labels.find(ch, first[node], first[node + 1])
+                    if index >= 0:
+                        node = index + 1
+                        break
+                node = fail[node]
+            else:
+                node = root.get(ch, 0)
+            if emits[node]:
+                match = node if node in out else link[node]
+                while match:
+                    length, tags = out[match]
+                    for tag in tags:
+                        yield i - length + 1, i + 1, tag
+                    match = link[match]
+
+    def find(self, text):
+        """
+        Возвращает {метка: [(начало, конец), ...]} по всем вхождениям в text.
+        Число вхождений категории — длина её списка.
+        Текст должен быть уже приведён к нижнему регистру.
+        """
+        hits = {}
+        for start, end, tag in self.iter_matches(text):
+            positions = hits.get(tag)
+            if positions is None:
+                hits[tag] = [(start, end)]
+            else:
+                positions.append((start, end))
+        return hits
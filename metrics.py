@@ -0,0 +1,162 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+
+# Границы корзин гистограмм задержек, секунды
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Этапы текущего запроса: список (этап, секунды) для заголовка Server-Timing
+_request_spans = contextvars.ContextVar('request_spans', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [счётчики по корзинам..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            i = bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = _format_labels(self.labelnames + ('le',), labels + (bound,))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _format_labels(self.labelnames + ('le',), labels + ('+Inf',))
+            lines.append(f"{self.name}_bucket{le} {series[-2]}")
+            suffix = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_count{suffix} {series[-2]}")
+            lines.append(f"{self.name}_sum{suffix} {series[-1]}")
+        return lines
+
+
+_metrics = []
+_collectors = []
+
+
+def counter(name, documentation, labelnames=()):
+    metric = Counter(name, documentation, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    metric = Histogram(name, documentation, labelnames, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def register_collector(prefix, documentation, stats_fn):
+    """Публикует словарь stats_fn() как набор gauge-метрик prefix_<ключ>"""
+    _collectors.append((prefix, documentation, stats_fn))
+
+
+# --- Общие метрики приложения ---
+REQUEST_DURATION = histogram(
+    'http_request_duration_seconds', 'Время обработки HTTP-запроса', ('endpoint', 'status'))
+STAGE_DURATION = histogram(
+    'stage_duration_seconds', 'Время этапов обработки запроса', ('stage',))
+UPSTREAM_RESPONSES = counter(
+    'yandex_upstream_responses_total', 'Ответы YandexGPT по коду статуса', ('status',))
+PROMPT_SOURCES = counter(
+    'build_prompt_results_total', 'Результаты генерации промпта по источнику', ('source',))
+
+
+def observe_stage(stage, seconds):
+    """Записывает длительность этапа в гистограмму и в Server-Timing текущего запроса"""
+    STAGE_DURATION.observe(seconds, stage)
+    spans = _request_spans.get()
+    if spans is not None:
+        spans.append((stage, seconds))
+
+
+class span:
+    """with span('этап'): ... — замеряет длительность блока (класс дешевле генераторного contextmanager)"""
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe_stage(self.stage, time.perf_counter() - self.start)
+
+
+def begin_request():
+    _request_spans.set([])
+
+
+def request_spans():
+    return _request_spans.get() or []
+
+
+def server_timing_header(spans):
+    return ', '.join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in spans)
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for prefix, documentation, stats_fn in _collectors:
+        for key, value in stats_fn().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                name = f"{prefix}_{key}"
+                lines.append(f"# HELP {name} {documentation}: {key}")
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+    return '\n'.join(lines) + '\n'
@@ -1,6 +1,8 @@
 # Настройки для целевых моделей, под которые мы оптимизируем
+# max_categories — сколько лучших категорий словаря попадает в промпт из БД
 MODELS_CONFIG = {
     "gpt-4o": {
+        "max_categories": 3,
         "description": "OpenAI GPT-4o / GPT-4 Turbo",
         "style_guide": """
         - Используй четкую иерархию с помощью Markdown (заголовки, списки).
@@ -10,6 +12,7 @@ MODELS_CONFIG = {
         """
     },
     "claude-3.5-sonnet": {
+        "max_categories": 4,
         "description": "Anthropic Claude 3.5",
         "style_guide": """
         - Используй XML-теги для структурирования (<context>, <task>, <examples>, <instructions>).
@@ -19,6 +22,7 @@ MODELS_CONFIG = {
         """
     },
     "midjourney": {
+        "max_categories": 2,
         "description": "Midjourney V6",
         "style_guide": """
         - Переводи промпт на английский язык (обязательно).
@@ -28,6 +32,7 @@ MODELS_CONFIG = {
         """
     },
     "gemini-2.0-pro": {
+        "max_categories": 3,
         "description": "Google Gemini Pro",
         "style_guide": """
         - Используй заголовки 'Instruction:', 'Context:', 'Constraint:'.
@@ -0,0 +1,283 @@
+import hashlib
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+
+from ai_cache import AI_CACHE_TTL
+from database import get_db_connection
+
+# Повторное использование ответов YandexGPT на почти одинаковые запросы
+AI_REUSE_ENABLED = os.environ.get('AI_REUSE_ENABLED', '1') != '0'
+# Минимальное сходство, при котором ответ берётся готовым.
+# По умолчанию 1.0: последовательности слов должны совпадать после нормализации,
+# то есть запросы отличаются только регистром, пунктуацией и словами-паразитами
+# («CSV в JSON» и «JSON в CSV» — разные задачи).
+# Ниже 1.0 — нечёткий режим: Жаккар по парам соседних слов, у кандидата должны
+# быть все слова запроса и те же отрицания, лишние слова допускаются только у кандидата.
+AI_REUSE_THRESHOLD = float(os.environ.get('AI_REUSE_THRESHOLD', 1.0))
+AI_REUSE_MAX_ENTRIES = int(os.environ.get('AI_REUSE_MAX_ENTRIES', 20000))
+# Не дольше кэша ответов: иначе повтор того же запроса после истечения кэша
+# получал бы устаревший ответ и помечался как повторно использованный
+AI_REUSE_TTL = float(os.environ.get('AI_REUSE_TTL', AI_CACHE_TTL))
+# Как часто подтягивать из SQLite записи, добавленные другими воркерами
+AI_REUSE_SYNC_INTERVAL = float(os.environ.get('AI_REUSE_SYNC_INTERVAL', 5))
+
+# MinHash: 64 хэш-функции, LSH из 16 полос по 4 значения
+# (кандидатами становятся пары со сходством примерно от 0.5, дальше точная проверка)
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+_ROWS_PER_BAND = MINHASH_PERMUTATIONS // LSH_BANDS
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20240601)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(MINHASH_PERMUTATIONS)]
+_PRUNE_EVERY = 256
+
+# Слова-паразиты, которые не меняют смысла задачи
+FILLER_WORDS = frozenset((
+    'пожалуйста', 'плиз', 'пж', 'ну', 'вот', 'же', 'просто', 'очень', 'можешь', 'можно',
+    'please', 'pls', 'plz', 'just', 'kindly', 'the', 'a', 'an',
+))
+
+# Отрицания: в нечётком режиме должны совпадать точно
+NEGATION_WORDS = frozenset((
+    'не', 'ни', 'нет', 'без', 'кроме', 'нельзя',
+    'no', 'not', 'nor', 'without', 'never', 'except', 'don', 'doesn', 'didn', 'isn', 'aren', 'cannot',
+))
+
+_WORD = re.compile(r'\w+')
+
+_Entry = namedtuple('_Entry', ['scope', 'tokens', 'words', 'shingles', 'signature', 'response', 'created_at'])
+
+
+def normalize(text):
+    """Слова задачи по порядку: без регистра, пунктуации и слов-паразитов"""
+    words = _WORD.findall(text.casefold().replace('ё', 'е'))
+    return tuple(word for word in words if word not in FILLER_WORDS)
+
+
+def shingles(tokens):
+    """Пары соседних слов (для запроса из одного слова — само слово): в них сохраняется порядок"""
+    if len(tokens) == 1:
+        return frozenset(tokens)
+    return frozenset(f"{first} {second}" for first, second in zip(tokens, tokens[1:]))
+
+
+def minhash(shingle_set):
+    """MinHash-подпись множества шинглов (кортеж из MINHASH_PERMUTATIONS чисел)"""
+    bases = [
+        int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+        for shingle in shingle_set
+    ]
+    return tuple(
+        min((a * base + b) % _PRIME for base in bases) & 0xFFFFFFFF
+        for a, b in _PERMUTATIONS
+    )
+
+
+def _compatible(words, candidate):
+    """
+    Можно ли отдать ответ кандидата на запрос: все слова запроса есть у кандидата
+    и отрицания совпадают. Одно новое смысловое слово («не», другой язык
+    программирования) меняет задачу, и Жаккар этого не замечает.
+    """
+    return words <= candidate and (words & NEGATION_WORDS) == (candidate & NEGATION_WORDS)
+
+
+def _make_entry(scope, tokens, response, created_at, signature=None):
+    entry_shingles = shingles(tokens)
+    if signature is None:
+        signature = minhash(entry_shingles)
+    return _Entry(scope, tokens, frozenset(tokens), entry_shingles, signature, response, created_at)
+
+
+def _bands(scope, signature):
+    for band in range(LSH_BANDS):
+        start = band * _ROWS_PER_BAND
+        yield (scope, band, signature[start:start + _ROWS_PER_BAND])
+
+
+class SimilarityIndex:
+    """
+    LSH-индекс по MinHash-подписям уже сгенерированных ответов.
+    Кандидаты из общих корзин LSH проверяются точно: при пороге 1.0 — совпадением
+    последовательности слов, ниже — коэффициентом Жаккара по шинглам.
+    В памяти хранится не больше max_entries записей (вытесняются давно
+    не использованные); записи сохраняются в таблицу ai_similar_prompts,
+    поэтому переживают перезапуск и видны другим воркерам.
+    """
+
+    def __init__(self, threshold=AI_REUSE_THRESHOLD, max_entries=AI_REUSE_MAX_ENTRIES,
+                 ttl=AI_REUSE_TTL, persist=True):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist = persist
+        self._entries = OrderedDict()  # id -> _Entry
+        self._buckets = {}             # (scope, полоса, значения) -> set(id)
+        self._lock = threading.Lock()
+        self._last_id = None
+        self._last_sync = 0.0
+        self._next_local_id = -1       # id записей без сохранения в БД
+        self._adds = 0
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evictions = 0
+
+    def _insert(self, entry_id, entry):
+        if entry_id in self._entries:
+            return
+        self._entries[entry_id] = entry
+        for bucket in _bands(entry.scope, entry.signature):
+            self._buckets.setdefault(bucket, set()).add(entry_id)
+        while len(self._entries) > self.max_entries:
+            old_id, old_entry = self._entries.popitem(last=False)
+            self._unlink(old_id, old_entry)
+            self.evictions += 1
+
+    def _unlink(self, entry_id, entry):
+        for bucket in _bands(entry.scope, entry.signature):
+            ids = self._buckets.get(bucket)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._buckets[bucket]
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if entry is not None:
+            self._unlink(entry_id, entry)
+
+    def _sync(self):
+        """Подгружает новые записи из SQLite (при первом вызове — последние max_entries)"""
+        if not self.persist or time.monotonic() - self._last_sync < AI_REUSE_SYNC_INTERVAL:
+            return
+        self._last_sync = time.monotonic()
+        try:
+            with get_db_connection() as conn:
+                if self._last_id is None:
+                    rows = conn.execute('''
+                        SELECT * FROM (
+                            SELECT id, scope, tokens, signature, response, created_at
+                            FROM ai_similar_prompts WHERE created_at > ?
+                            ORDER BY id DESC LIMIT ?
+                        ) ORDER BY id
+                    ''', (time.time() - self.ttl, self.max_entries)).fetchall()
+                else:
+                    rows = conn.execute('''
+                        SELECT id, scope, tokens, signature, response, created_at
+                        FROM ai_similar_prompts WHERE id > ?
+                        ORDER BY id LIMIT ?
+                    ''', (self._last_id, self.max_entries)).fetchall()
+        except sqlite3.Error as e:
+            print(f"AI reuse index read error: {e}")
+            return
+        with self._lock:
+            for row in rows:
+                self._insert(row['id'], _make_entry(row['scope'], tuple(row['tokens'].split()),
+                                                    row['response'], row['created_at'],
+                                                    tuple(array('I', row['signature']))))
+            if rows:
+                self._last_id = max(self._last_id or 0, rows[-1]['id'])
+            elif self._last_id is None:
+                self._last_id = 0
+
+    def lookup(self, scope, text):
+        """Готовый ответ на похожий запрос в той же области (модель, инструкции) или None"""
+        tokens = normalize(text)
+        if not tokens:
+            return None
+        self._sync()
+        query = _make_entry(scope, tokens, None, None)
+        exact = self.threshold >= 1.0
+        now = time.time()
+        with self._lock:
+            candidates = set()
+            for bucket in _bands(scope, query.signature):
+                candidates.update(self._buckets.get(bucket, ()))
+            best_id, best_score = None, self.threshold
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                if entry.created_at + self.ttl <= now:
+                    self._remove(entry_id)
+                    continue
+                if exact:
+                    score = 1.0 if entry.tokens == tokens else 0.0
+                elif _compatible(query.words, entry.words):
+                    score = len(query.shingles & entry.shingles) / len(query.shingles | entry.shingles)
+                else:
+                    continue
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return self._entries[best_id].response
+
+    def add(self, scope, text, response):
+        """Запоминает сгенерированный ответ для будущих похожих запросов"""
+        tokens = normalize(text)
+        if not tokens:
+            return
+        entry = _make_entry(scope, tokens, response, time.time())
+        entry_id = None
+        if self.persist:
+            entry_id = self._persist(entry)
+        with self._lock:
+            if entry_id is None:
+                entry_id = self._next_local_id
+                self._next_local_id -= 1
+            self._insert(entry_id, entry)
+            self.stored += 1
+
+    def _persist(self, entry):
+        try:
+            with get_db_connection() as conn:
+                entry_id = conn.execute(
+                    "INSERT INTO ai_similar_prompts (scope, tokens, signature, response, created_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (entry.scope, ' '.join(entry.tokens), array('I', entry.signature).tobytes(),
+                     entry.response, entry.created_at)
+                ).lastrowid
+                self._adds += 1
+                if self._adds % _PRUNE_EVERY == 0:
+                    conn.execute("DELETE FROM ai_similar_prompts WHERE created_at <= ?",
+                                 (time.time() - self.ttl,))
+                    conn.execute('''
+                        DELETE FROM ai_similar_prompts WHERE id <= (
+                            SELECT id FROM ai_similar_prompts ORDER BY id DESC LIMIT 1 OFFSET ?
+                        )
+                    ''', (self.max_entries,))
+                return entry_id
+        except sqlite3.Error as e:
+            print(f"AI reuse index write error: {e}")
+            return None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+        if self.persist:
+            with get_db_connection() as conn:
+                conn.execute("DELETE FROM ai_similar_prompts")
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stored": self.stored,
+            "evictions": self.evictions,
+        }
+
+
+# Общий индекс процесса для клиента YandexGPT (None — повторное использование выключено)
+similarity_index = SimilarityIndex() if AI_REUSE_ENABLED else None
@@ -0,0 +1,151 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from metrics import span
+
+# Метод хэширования в формате werkzeug (например "scrypt" или "pbkdf2:sha256:600000").
+# Пусто — метод werkzeug по умолчанию. При смене метода хэш пересчитывается при входе.
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or None
+# Число процессов для хэширования (0 — считать в потоке запроса)
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 2))
+# Сколько операций может ждать/выполняться одновременно; сверх этого — отказ (503)
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 64))
+PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 30))
+# Способ запуска процессов пула. fork из многопоточного воркера небезопасен
+# (в нём уже работают потоки записи промптов и пакетной генерации)
+PASSWORD_HASH_START_METHOD = os.environ.get('PASSWORD_HASH_START_METHOD') or (
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+
+class HashingOverloaded(Exception):
+    """Очередь хэширования паролей заполнена или результат не дождались за timeout"""
+
+
+def _hash(password, method):
+    if method:
+        return generate_password_hash(password, method)
+    return generate_password_hash(password)
+
+
+def _check(password_hash, password):
+    return check_password_hash(password_hash, password)
+
+
+class PasswordHasher:
+    """
+    Выносит хэширование паролей (намеренно тяжёлые KDF) в пул процессов,
+    чтобы всплеск логинов не занимал потоки запросов и не упирался в GIL.
+    """
+
+    def __init__(self, method=PASSWORD_HASH_METHOD, workers=PASSWORD_HASH_WORKERS,
+                 max_pending=PASSWORD_HASH_MAX_PENDING, timeout=PASSWORD_HASH_TIMEOUT):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._method_prefix = None
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.rehashed = 0
+
+    def _get_executor(self):
+        # Пул процессов свой у каждого воркера gunicorn (создаётся при первом обращении)
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                context = multiprocessing.get_context(PASSWORD_HASH_START_METHOD)
+                if PASSWORD_HASH_START_METHOD == 'forkserver':
+                    # Сервер заранее импортирует только этот модуль (и werkzeug),
+                    # а не запущенный скрипт: процессы пула от него форкаются готовыми
+                    context.set_forkserver_preload(['password_hashing'])
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._stats_lock:
+                self.rejected += 1
+            raise HashingOverloaded()
+        with self._stats_lock:
+            self.pending += 1
+        with span("password_hash"):
+            return self._execute(fn, *args)
+
+    def _release(self, _future=None):
+        # Слот освобождается, только когда операция действительно завершилась,
+        # поэтому max_pending ограничивает и то, что ещё считается в процессах пула
+        with self._stats_lock:
+            self.pending -= 1
+            self.completed += 1
+        self._slots.release()
+
+    def _execute(self, fn, *args):
+        if self.workers <= 0:
+            try:
+                return fn(*args)
+            finally:
+                self._release()
+        executor = self._get_executor()
+        try:
+            future = executor.submit(fn, *args)
+        except BaseException as e:
+            self._release()
+            if isinstance(e, BrokenProcessPool):
+                self._drop_executor(executor)
+            raise
+        future.add_done_callback(self._release)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()  # если ещё не начали считать
+            raise HashingOverloaded() from None
+        except BrokenProcessPool:
+            self._drop_executor(executor)
+            raise
+
+    def _drop_executor(self, executor):
+        # Сломанный пул пересоздаётся при следующем обращении
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+    def hash(self, password):
+        return self._run(_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(_check, password_hash, password)
+
+    def record_rehash(self):
+        with self._stats_lock:
+            self.rehashed += 1
+
+    def needs_rehash(self, password_hash):
+        """Хэш посчитан с другими параметрами, чем настроено сейчас"""
+        if self._method_prefix is None:
+            # Полную строку метода (с параметрами по умолчанию) узнаём по пробному хэшу
+            self._method_prefix = self.hash('').split('$', 1)[0]
+        return password_hash.split('$', 1)[0] != self._method_prefix
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "rehashed": self.rehashed,
+        }
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,141 @@
+# Обслуживание истории промптов: сжатие, словарь сжатия и перенос в архив.
+#
+#   python prompt_archive.py archive [--days 180]    — старые записи в архив
+#   python prompt_archive.py train-dictionary        — обучить общий словарь zlib
+#   python prompt_archive.py compress                — сжать записи, сохранённые без сжатия
+#   python prompt_archive.py reindex                 — перестроить поиск по истории
+#
+# Архив — таблица saved_prompts_archive в основной базе или в отдельном файле
+# (PROMPT_ARCHIVE_DB). /api/history читает обе таблицы, поиск по истории
+# охватывает только неархивные записи. Поисковый индекс ведёт приложение; после
+# изменения saved_prompts в обход него (sqlite3 CLI, скрипты) нужен reindex.
+# Каждая пачка переносится одной транзакцией; при отдельном файле архива
+# SQLite в режиме WAL гарантирует атомарность только в пределах каждого файла,
+# поэтому после сбоя запись может оказаться в обеих таблицах (повторный запуск
+# это исправит: вставка в архив идёт через INSERT OR REPLACE).
+import argparse
+import os
+import time
+
+from compression import PROMPT_COMPRESS_MIN_BYTES, ZDICT_SIZE, decode_text, encode_text, train_dictionary
+from database import ARCHIVE_TABLE, get_db_connection, init_db
+from prompt_store import rebuild_search_index, unindex_prompts
+
+# Записи старше этого возраста (в днях) переносятся в архив
+PROMPT_ARCHIVE_AFTER_DAYS = int(os.environ.get('PROMPT_ARCHIVE_AFTER_DAYS', 180))
+PROMPT_ARCHIVE_BATCH_SIZE = int(os.environ.get('PROMPT_ARCHIVE_BATCH_SIZE', 1000))
+# Архив читается редко, поэтому сжимается всё, что хоть немного сжимается
+PROMPT_ARCHIVE_COMPRESS_MIN_BYTES = int(os.environ.get('PROMPT_ARCHIVE_COMPRESS_MIN_BYTES', 64))
+# Сколько последних текстов брать образцами для обучения словаря
+ZDICT_SAMPLES = int(os.environ.get('ZDICT_SAMPLES', 5000))
+
+
+def archive_prompts(days=PROMPT_ARCHIVE_AFTER_DAYS, batch_size=PROMPT_ARCHIVE_BATCH_SIZE):
+    """Переносит записи старше days дней в архив. Возвращает число перенесённых записей"""
+    cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - days * 86400))
+    moved = 0
+    with get_db_connection() as conn:
+        while True:
+            rows = conn.execute('''
+                SELECT id, user_id, prompt_type, input_text, output_text, created_at
+                FROM saved_prompts WHERE created_at < ?
+                ORDER BY id LIMIT ?
+            ''', (cutoff, batch_size)).fetchall()
+            if not rows:
+                return moved
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {ARCHIVE_TABLE} "
+                "(id, user_id, prompt_type, input_text, output_text, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (row['id'], row['user_id'], row['prompt_type'],
+                     _recompress(row['input_text']), _recompress(row['output_text']), row['created_at'])
+                    for row in rows
+                ]
+            )
+            unindex_prompts(conn, [
+                (row['id'], row['user_id'], decode_text(row['input_text']), decode_text(row['output_text']))
+                for row in rows
+            ])
+            conn.executemany("DELETE FROM saved_prompts WHERE id = ?", [(row['id'],) for row in rows])
+            conn.commit()
+            moved += len(rows)
+
+
+def _recompress(value, min_bytes=PROMPT_ARCHIVE_COMPRESS_MIN_BYTES):
+    if value is None or not isinstance(value, str):
+        return value
+    return encode_text(value, min_bytes)
+
+
+def train_compression_dictionary(samples=ZDICT_SAMPLES, size=ZDICT_SIZE):
+    """Обучает словарь по последним текстам истории и делает его активным. Возвращает id или None"""
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT input_text, output_text FROM saved_prompts ORDER BY id DESC LIMIT ?", (samples,)
+        ).fetchall()
+        texts = [decode_text(value) for row in rows for value in row if value]
+        zdict = train_dictionary(texts, size)
+        if not zdict:
+            return None
+        dict_id = conn.execute("INSERT INTO compression_dictionaries (zdict) VALUES (?)", (zdict,)).lastrowid
+        conn.commit()
+        return dict_id
+
+
+def compress_prompts(batch_size=PROMPT_ARCHIVE_BATCH_SIZE):
+    """Сжимает тексты записей, сохранённых без сжатия. Возвращает число изменённых записей"""
+    changed = 0
+    last_id = 0
+    with get_db_connection() as conn:
+        while True:
+            rows = conn.execute('''
+                SELECT id, input_text, output_text FROM saved_prompts
+                WHERE id > ? AND (typeof(input_text) = 'text' OR typeof(output_text) = 'text')
+                ORDER BY id LIMIT ?
+            ''', (last_id, batch_size)).fetchall()
+            if not rows:
+                return changed
+            last_id = rows[-1]['id']
+            updates = []
+            for row in rows:
+                input_text = _recompress(row['input_text'], PROMPT_COMPRESS_MIN_BYTES)
+                output_text = _recompress(row['output_text'], PROMPT_COMPRESS_MIN_BYTES)
+                if input_text is not row['input_text'] or output_text is not row['output_text']:
+                    updates.append((input_text, output_text, row['id']))
+            # Текст не меняется, поэтому поисковый индекс трогать не нужно
+            conn.executemany("UPDATE saved_prompts SET input_text = ?, output_text = ? WHERE id = ?", updates)
+            conn.commit()
+            changed += len(updates)
+
+
+def reindex_prompts():
+    """Перестраивает поиск по истории из текущего содержимого saved_prompts"""
+    with get_db_connection() as conn:
+        rebuild_search_index(conn)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Сжатие и архивирование истории промптов")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    archive_parser = subparsers.add_parser('archive', help="перенести старые записи в архив")
+    archive_parser.add_argument('--days', type=int, default=PROMPT_ARCHIVE_AFTER_DAYS)
+    archive_parser.add_argument('--batch-size', type=int, default=PROMPT_ARCHIVE_BATCH_SIZE)
+    train_parser = subparsers.add_parser('train-dictionary', help="обучить словарь сжатия")
+    train_parser.add_argument('--samples', type=int, default=ZDICT_SAMPLES)
+    train_parser.add_argument('--size', type=int, default=ZDICT_SIZE)
+    compress_parser = subparsers.add_parser('compress', help="сжать записи, сохранённые без сжатия")
+    compress_parser.add_argument('--batch-size', type=int, default=PROMPT_ARCHIVE_BATCH_SIZE)
+    subparsers.add_parser('reindex', help="перестроить поиск по истории")
+    args = parser.parse_args()
+
+    init_db()
+    if args.command == 'archive':
+        print(f"Перенесено в архив: {archive_prompts(args.days, args.batch_size)}")
+    elif args.command == 'train-dictionary':
+        dict_id = train_compression_dictionary(args.samples, args.size)
+        print(f"Словарь сжатия: {dict_id}" if dict_id else "Недостаточно текстов для словаря")
+    elif args.command == 'compress':
+        print(f"Сжато записей: {compress_prompts(args.batch_size)}")
+    else:
+        reindex_prompts()
+        print("Поиск по истории перестроен")
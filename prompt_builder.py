@@ -1,100 +1,243 @@
-import json
 import os
-from database import get_db_connection
-from yandex_ai import generate_with_ai
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from category_scoring import max_categories_for, select_categories
+from dictionary_cache import get_snapshot
+from lru import LRUCache
+from metrics import PROMPT_SOURCES, span
+from yandex_ai import YandexGPTStreamError, generate_with_ai, is_ai_available, stream_with_ai
+
+# Сколько скомпилированных шаблонов (локаль, модель, набор категорий) держать в памяти
+TEMPLATE_CACHE_SIZE = int(os.environ.get('TEMPLATE_CACHE_SIZE', 4096))
+
+# Пакетная генерация: сколько запросов к ИИ одного пакета идут одновременно,
+# сколько потоков на процесс обслуживают все пакеты и сколько элементов допускается в пакете
+BUILD_BATCH_CONCURRENCY = int(os.environ.get('BUILD_BATCH_CONCURRENCY', 8))
+BUILD_BATCH_WORKERS = int(os.environ.get('BUILD_BATCH_WORKERS', 32))
+BUILD_BATCH_MAX_ITEMS = int(os.environ.get('BUILD_BATCH_MAX_ITEMS', 500))
+
+_template_cache = LRUCache(TEMPLATE_CACHE_SIZE)
+
+_batch_executor = None
+_batch_pid = None
+_batch_lock = threading.Lock()
+
+
+def _compile_template(snapshot, model_key, matches):
+    """
+    Готовит всё, что не зависит от текста пользователя, для набора категорий:
+    промпт = prefix + user_input + suffix.
+    """
+    conn_dict = snapshot.connectors
+    locale = snapshot.locale
+    
+    # Получаем правило модели
+    model_rule = snapshot.model_rules.get(model_key)
+    if model_rule is None:
+        model_rule = snapshot.model_rules.get('default', "Будь точным и следуй инструкциям.")
+    
+    # Сортировка по приоритету (убывание)
+    matches = sorted(matches, key=lambda x: x.priority, reverse=True)
+    
+    # Уникальные роли (в порядке приоритета)
+    roles = list(dict.fromkeys(match.role for match in matches))
+    if len(roles) > 1:
+        role_text = ', '.join(roles[:-1]) + (f" {('и' if locale=='ru' else 'and')} " + roles[-1])
+    else:
+        role_text = roles[0]
+    
+    # Сбор фраз из полей (уже разобранные кортежи)
+    def merge_phrases(field):
+        phrases = []
+        for m in matches:
+            phrases.extend(getattr(m, field))
+        return list(dict.fromkeys(phrases))  # уникальные
+    
+    pos_phrases = merge_phrases('pos_phrases')
+    neg_phrases = merge_phrases('neg_phrases')
+    format_phrases = merge_phrases('format_phrases')
+    
+    # Сборка шаблона: всё до текста пользователя и всё после него
+    prefix = f"{conn_dict.get('intro', 'Act as')} {role_text}. {conn_dict.get('task', 'Your main task is')} "
+    parts = ["."]
+    if pos_phrases:
+        parts.append(f"{conn_dict.get('style', 'While working on this')} {', '.join(pos_phrases)}.")
+    if neg_phrases:
+        parts.append(f"{conn_dict.get('avoid', 'strictly avoiding')} {', '.join(neg_phrases)}.")
+    if format_phrases:
+        parts.append(f"{conn_dict.get('ending', 'Provide the output using')} {', '.join(format_phrases)}.")
+    parts.append(f"[Контекст модели]: {model_rule}")
+    
+    return prefix, ' '.join(parts)
+
 
 def build_from_db(user_input, model_key, locale='ru'):
     """
     Собирает промпт по шаблонам из БД (аналог старой buildPrompt).
+    Словарь берётся из снимка в памяти (см. dictionary_cache), а шаблон для
+    набора категорий компилируется один раз, поэтому на горячем пути остаются
+    только поиск ключевых слов и одна склейка с текстом пользователя.
     Возвращает строку промпта или None, если нет данных.
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Получаем коннекторы
-        conn_data = cursor.execute(
-            "SELECT key_name, phrase FROM connectors WHERE locale = ?", (locale,)
-        ).fetchall()
-        conn_dict = {row['key_name']: row['phrase'] for row in conn_data}
-        
-        # Получаем правило модели
-        rule_row = cursor.execute(
-            "SELECT rule_text FROM model_rules WHERE model_key = ?", (model_key,)
-        ).fetchone()
-        if not rule_row:
-            rule_row = cursor.execute("SELECT rule_text FROM model_rules WHERE model_key = 'default'").fetchone()
-        model_rule = rule_row['rule_text'] if rule_row else "Будь точным и следуй инструкциям."
-        
-        # Загружаем все категории с локализацией
-        cats = cursor.execute('''
-            SELECT c.category_id, c.priority, c.keywords,
-                   cl.role, cl.pos_phrases, cl.neg_phrases, cl.format_phrases
-            FROM categories c
-            JOIN category_localized cl ON c.category_id = cl.category_id
-            WHERE cl.locale = ?
-        ''', (locale,)).fetchall()
-        
-        # Поиск совпадений по ключевым словам
+    with span("dictionary"):
+        snapshot = get_snapshot(locale)
+    return _build_from_snapshot(snapshot, user_input, model_key)
+
+
+def _build_from_snapshot(snapshot, user_input, model_key):
+    # Поиск совпадений по ключевым словам: один проход автомата по тексту,
+    # затем в промпт идут только лучшие по оценке категории (их число задаётся для модели)
+    with span("match"):
         input_lower = user_input.lower()
-        matches = []
-        for cat in cats:
-            keywords = json.loads(cat['keywords'])
-            if any(kw.lower() in input_lower for kw in keywords):
-                matches.append(cat)
-        if not matches:
-            # fallback на категорию improve
-            matches = [c for c in cats if c['category_id'] == 'improve']
-        if not matches:
-            return None
-        
-        # Сортировка по приоритету (убывание)
-        matches.sort(key=lambda x: x['priority'], reverse=True)
-        
-        # Уникальные роли
-        roles = list({match['role'] for match in matches})
-        if len(roles) > 1:
-            role_text = ', '.join(roles[:-1]) + (f" {('и' if locale=='ru' else 'and')} " + roles[-1])
-        else:
-            role_text = roles[0]
-        
-        # Сбор фраз из полей (массивы JSON)
-        def merge_phrases(field):
-            phrases = []
-            for m in matches:
-                arr = json.loads(m[field])
-                phrases.extend(arr)
-            return list(dict.fromkeys(phrases))  # уникальные
-        
-        pos_phrases = merge_phrases('pos_phrases')
-        neg_phrases = merge_phrases('neg_phrases')
-        format_phrases = merge_phrases('format_phrases')
-        
-        # Сборка промпта
-        parts = [
-            f"{conn_dict.get('intro', 'Act as')} {role_text}.",
-            f"{conn_dict.get('task', 'Your main task is')} {user_input}.",
-        ]
-        if pos_phrases:
-            parts.append(f"{conn_dict.get('style', 'While working on this')} {', '.join(pos_phrases)}.")
-        if neg_phrases:
-            parts.append(f"{conn_dict.get('avoid', 'strictly avoiding')} {', '.join(neg_phrases)}.")
-        if format_phrases:
-            parts.append(f"{conn_dict.get('ending', 'Provide the output using')} {', '.join(format_phrases)}.")
-        parts.append(f"[Контекст модели]: {model_rule}")
-        
-        return ' '.join(parts)
+        hits = snapshot.matcher.find(input_lower)
+        matches = select_categories(input_lower, hits, snapshot.categories_by_id, max_categories_for(model_key))
+    if not matches:
+        # fallback на категорию improve
+        matches = [c for c in snapshot.categories if c.category_id == 'improve']
+    if not matches:
+        return None
+    
+    with span("template"):
+        key = (snapshot.generation, snapshot.locale, model_key, tuple(sorted(cat.category_id for cat in matches)))
+        template = _template_cache.get(key)
+        if template is None:
+            template = _compile_template(snapshot, model_key, matches)
+            _template_cache.put(key, template)
+    
+    prefix, suffix = template
+    return prefix + user_input + suffix
 
 
 def build_prompt(user_input, model_key, locale='ru', auto_learn=False, use_instructions=False):
+    """
+    Возвращает (текст, source, reused). reused=True — ИИ-ответ взят готовым
+    с почти такого же запроса (см. near_duplicates).
+    """
     # 1. Пытаемся использовать ИИ
-    ai_result = generate_with_ai(user_input, model_key, locale, use_instructions)
+    ai_result, reused = generate_with_ai(user_input, model_key, locale, use_instructions)
     if ai_result:
-        return ai_result, "ai"
+        PROMPT_SOURCES.inc("ai")
+        return ai_result, "ai", reused
     
     # 2. Fallback на БД
     db_result = build_from_db(user_input, model_key, locale)
     if db_result:
-        return db_result, "database"
+        PROMPT_SOURCES.inc("database")
+        return db_result, "database", False
     
     # 3. Абсолютный fallback
-    return user_input, "fallback"
+    PROMPT_SOURCES.inc("fallback")
+    return user_input, "fallback", False
+
+
+def build_prompt_stream(user_input, model_key, locale='ru', auto_learn=False, use_instructions=False):
+    """
+    Потоковая версия build_prompt: генерирует пары (фрагмент текста, source).
+    Если поток ИИ оборвался до первого фрагмента — отдаёт результат из БД одним куском.
+    Обрыв после первого фрагмента пробрасывается как YandexGPTStreamError.
+    """
+    # 1. Пытаемся использовать ИИ в потоковом режиме
+    chunks = stream_with_ai(user_input, model_key, locale, use_instructions)
+    if chunks is not None:
+        try:
+            first = next(chunks, None)
+        except YandexGPTStreamError:
+            first = None
+        if first is not None:
+            PROMPT_SOURCES.inc("ai")
+            yield first, "ai"
+            for chunk in chunks:
+                yield chunk, "ai"
+            return
+    
+    # 2. Fallback на БД
+    db_result = build_from_db(user_input, model_key, locale)
+    if db_result:
+        PROMPT_SOURCES.inc("database")
+        yield db_result, "database"
+        return
+    
+    # 3. Абсолютный fallback
+    PROMPT_SOURCES.inc("fallback")
+    yield user_input, "fallback"
+
+
+def _get_batch_executor():
+    # Пул потоков свой у каждого воркера gunicorn (потоки не переживают fork)
+    global _batch_executor, _batch_pid
+    with _batch_lock:
+        if _batch_executor is None or _batch_pid != os.getpid():
+            _batch_executor = ThreadPoolExecutor(max_workers=BUILD_BATCH_WORKERS, thread_name_prefix="build-batch")
+            _batch_pid = os.getpid()
+        return _batch_executor
+
+
+def build_prompts_batch(items, concurrency=BUILD_BATCH_CONCURRENCY):
+    """
+    Пакетная версия build_prompt. items — список кортежей
+    (user_input, model_key, locale, use_instructions).
+    Генерирует пары (позиции в items, результат) по мере готовности, где результат —
+    (текст, source, reused) или исключение, если элемент собрать не удалось.
+    Одинаковые элементы генерируются один раз; запросы к ИИ идут параллельно
+    (не больше concurrency на пакет), а путь через БД использует снимки словаря,
+    загруженные один раз на весь пакет.
+    """
+    groups = {}
+    for position, item in enumerate(items):
+        groups.setdefault(item, []).append(position)
+
+    with span("dictionary"):
+        snapshots = {locale: get_snapshot(locale) for _, _, locale, _ in groups}
+
+    def resolve(item, ai_result, reused=False):
+        user_input, model_key, locale, _ = item
+        if ai_result:
+            PROMPT_SOURCES.inc("ai")
+            return ai_result, "ai", reused
+        try:
+            db_result = _build_from_snapshot(snapshots[locale], user_input, model_key)
+        except Exception as e:
+            print(f"Ошибка сборки промпта из БД: {e}")
+            return e
+        if db_result:
+            PROMPT_SOURCES.inc("database")
+            return db_result, "database", False
+        PROMPT_SOURCES.inc("fallback")
+        return user_input, "fallback", False
+
+    if not is_ai_available():
+        for item, positions in groups.items():
+            yield positions, resolve(item, None)
+        return
+
+    executor = _get_batch_executor()
+    queued = iter(groups.items())
+    running = {}
+
+    def submit_next():
+        for item, positions in queued:
+            user_input, model_key, locale, use_instructions = item
+            future = executor.submit(generate_with_ai, user_input, model_key, locale, use_instructions)
+            running[future] = (item, positions)
+            return
+
+    try:
+        for _ in range(max(1, concurrency)):
+            submit_next()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            finished = [running.pop(future) + (future,) for future in done]
+            for _ in finished:
+                submit_next()
+            for item, positions, future in finished:
+                try:
+                    ai_result, reused = future.result()
+                except Exception as e:
+                    print(f"YandexGPT batch error: {e}")
+                    ai_result, reused = None, False
+                yield positions, resolve(item, ai_result, reused)
+    finally:
+        # Клиент отключился — не запускаем то, что ещё не начато
+        for future in running:
+            future.cancel()
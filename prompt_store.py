@@ -0,0 +1,421 @@
+import atexit
+import base64
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+from compression import decode_text, encode_text
+from database import ARCHIVE_TABLE, get_db_connection
+from lru import LRUCache
+from metrics import span
+
+# Настройки выдачи истории
+HISTORY_DEFAULT_LIMIT = int(os.environ.get('HISTORY_DEFAULT_LIMIT', 50))
+HISTORY_MAX_LIMIT = int(os.environ.get('HISTORY_MAX_LIMIT', 200))
+HISTORY_PREVIEW_CHARS = int(os.environ.get('HISTORY_PREVIEW_CHARS', 200))
+
+# Настройки полнотекстового поиска по истории
+SEARCH_DEFAULT_LIMIT = int(os.environ.get('SEARCH_DEFAULT_LIMIT', 20))
+SEARCH_MAX_LIMIT = int(os.environ.get('SEARCH_MAX_LIMIT', 100))
+SEARCH_MAX_OFFSET = int(os.environ.get('SEARCH_MAX_OFFSET', 1000))
+SEARCH_MAX_TERMS = int(os.environ.get('SEARCH_MAX_TERMS', 16))
+SEARCH_SNIPPET_TOKENS = int(os.environ.get('SEARCH_SNIPPET_TOKENS', 12))
+# Маркеры найденных слов в сниппетах
+SEARCH_HIGHLIGHT_START = '['
+SEARCH_HIGHLIGHT_END = ']'
+
+_SEARCH_TERM = re.compile(r'\w+')
+
+# Кэш ответа load_last_prompts в памяти процесса. Сброс происходит при сохранении
+# в этом же процессе, запись через другой воркер обнаруживается по версии
+# истории пользователя (user_versions); TTL — страховка для вызовов без версии.
+LAST_PROMPTS_CACHE_SIZE = int(os.environ.get('LAST_PROMPTS_CACHE_SIZE', 10000))
+LAST_PROMPTS_CACHE_TTL = float(os.environ.get('LAST_PROMPTS_CACHE_TTL', 5))
+
+_last_prompts_cache = LRUCache(LAST_PROMPTS_CACHE_SIZE, LAST_PROMPTS_CACHE_TTL)
+
+# Настройки группировки записей saved_prompts.
+# SAVE_PROMPT_ACK: 'commit' — ответ после фиксации транзакции, 'enqueue' — сразу после постановки в очередь
+SAVE_PROMPT_ACK = os.environ.get('SAVE_PROMPT_ACK', 'commit')
+SAVE_BATCH_SIZE = int(os.environ.get('SAVE_BATCH_SIZE', 500))
+# Сколько под нагрузкой ждать добора пакета (0 — писать сразу всё накопившееся)
+SAVE_FLUSH_INTERVAL = float(os.environ.get('SAVE_FLUSH_INTERVAL', 0))
+SAVE_QUEUE_SIZE = int(os.environ.get('SAVE_QUEUE_SIZE', 10000))
+SAVE_ENQUEUE_TIMEOUT = float(os.environ.get('SAVE_ENQUEUE_TIMEOUT', 1))
+SAVE_COMMIT_TIMEOUT = float(os.environ.get('SAVE_COMMIT_TIMEOUT', 10))
+# Максимум промптов в одном запросе к пакетному эндпоинту
+SAVE_BATCH_MAX_ITEMS = int(os.environ.get('SAVE_BATCH_MAX_ITEMS', 1000))
+
+ACK_MODES = ('commit', 'enqueue')
+
+_INSERT_PROMPT = "INSERT INTO saved_prompts (user_id, prompt_type, input_text, output_text) VALUES (?, ?, ?, ?)"
+# Полнотекстовый индекс ведётся из Python, где есть несжатый текст: триггерам на
+# saved_prompts пришлось бы распаковывать тексты функцией, которой нет у обычных
+# соединений (sqlite3 CLI, скрипты обслуживания)
+_INDEX_PROMPT = "INSERT INTO saved_prompts_fts (rowid, user_id, input_text, output_text) VALUES (?, ?, ?, ?)"
+_UNINDEX_PROMPT = (
+    "INSERT INTO saved_prompts_fts (saved_prompts_fts, rowid, user_id, input_text, output_text) "
+    "VALUES ('delete', ?, ?, ?, ?)"
+)
+
+
+def encode_cursor(created_at, row_id):
+    """Курсор страницы — позиция последней выданной строки (created_at, id)"""
+    raw = f"{created_at}|{row_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Разбирает курсор; при неверном формате поднимает ValueError"""
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(padded).decode('utf-8').rsplit('|', 1)
+        return created_at, int(row_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError("Неверный курсор") from e
+
+
+def fetch_history(conn, user_id, limit=HISTORY_DEFAULT_LIMIT, cursor=None, prompt_type=None, preview=False):
+    """
+    Возвращает страницу истории (новые сверху) и курсор следующей страницы.
+    Пагинация по ключу (created_at, id) идёт по индексу, поэтому стоимость
+    страницы не зависит от её номера и размера всей истории. Архив читается
+    тем же запросом (слиянием по индексам), тексты распаковываются только
+    для строк страницы.
+    """
+    limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+
+    where = ["user_id = ?"]
+    params = [user_id]
+    if prompt_type:
+        where.append("prompt_type = ?")
+        params.append(prompt_type)
+    if cursor:
+        where.append("(created_at, id) < (?, ?)")
+        params.extend(decode_cursor(cursor))
+
+    select = ' UNION ALL '.join(
+        f"SELECT id, prompt_type, input_text, output_text, created_at FROM {table} WHERE {' AND '.join(where)}"
+        for table in ('saved_prompts', ARCHIVE_TABLE)
+    )
+    rows = conn.execute(f'''
+        {select}
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+    ''', params * 2 + [limit + 1]).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id'])
+    items = []
+    for row in rows:
+        input_text = decode_text(row['input_text'])
+        output_text = decode_text(row['output_text'])
+        if preview:
+            input_text = input_text[:HISTORY_PREVIEW_CHARS] if input_text else input_text
+            output_text = output_text[:HISTORY_PREVIEW_CHARS] if output_text else output_text
+        items.append({
+            "prompt_type": row['prompt_type'],
+            "input_text": input_text,
+            "output_text": output_text,
+            "created_at": row['created_at'],
+        })
+    return items, next_cursor
+
+
+def _fts_query(user_id, text):
+    """
+    Строит выражение MATCH из текста пользователя: слова берутся в кавычки
+    (операторы FTS5 в запросе не работают), последнее ищется по префиксу.
+    Слова ищутся только в текстовых колонках, иначе запрос «12» совпал бы
+    с колонкой user_id у всех записей пользователя 12.
+    """
+    terms = _SEARCH_TERM.findall(text)[:SEARCH_MAX_TERMS]
+    if not terms:
+        raise ValueError("Пустой запрос")
+    phrases = [f'"{term}"' for term in terms]
+    phrases[-1] += '*'
+    return f'user_id:"{int(user_id)}" AND {{input_text output_text}}: ({" ".join(phrases)})'
+
+
+def _encode_offset(offset):
+    return base64.urlsafe_b64encode(str(offset).encode('ascii')).decode('ascii').rstrip('=')
+
+
+def _decode_offset(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        offset = int(base64.urlsafe_b64decode(padded).decode('ascii'))
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError("Неверный курсор") from e
+    if not 0 <= offset <= SEARCH_MAX_OFFSET:
+        raise ValueError("Неверный курсор")
+    return offset
+
+
+def search_history(conn, user_id, text, limit=SEARCH_DEFAULT_LIMIT, cursor=None, prompt_type=None):
+    """
+    Полнотекстовый поиск по истории пользователя через индекс saved_prompts_fts.
+    Возвращает страницу результатов (лучшие по BM25 сверху) со сниппетами
+    и курсор следующей страницы. При пустом запросе или неверном курсоре — ValueError.
+    """
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    offset = _decode_offset(cursor) if cursor else 0
+    snippet_args = (SEARCH_HIGHLIGHT_START, SEARCH_HIGHLIGHT_END, '…', SEARCH_SNIPPET_TOKENS)
+
+    where = ["saved_prompts_fts MATCH ?"]
+    params = [*snippet_args, *snippet_args, _fts_query(user_id, text)]
+    if prompt_type:
+        where.append("s.prompt_type = ?")
+        params.append(prompt_type)
+    params.extend((limit + 1, offset))
+
+    # Вес колонки user_id нулевой: она нужна только для отбора записей пользователя
+    rows = conn.execute(f'''
+        SELECT s.id, s.prompt_type, s.created_at,
+               snippet(saved_prompts_fts, 1, ?, ?, ?, ?) AS input_snippet,
+               snippet(saved_prompts_fts, 2, ?, ?, ?, ?) AS output_snippet
+        FROM saved_prompts_fts
+        JOIN saved_prompts s ON s.id = saved_prompts_fts.rowid
+        WHERE {' AND '.join(where)}
+        ORDER BY bm25(saved_prompts_fts, 0.0, 1.0, 1.0), s.id DESC
+        LIMIT ? OFFSET ?
+    ''', params).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        if offset + limit <= SEARCH_MAX_OFFSET:
+            next_cursor = _encode_offset(offset + limit)
+    items = [
+        {
+            "id": row['id'],
+            "prompt_type": row['prompt_type'],
+            "input_snippet": row['input_snippet'],
+            "output_snippet": row['output_snippet'],
+            "created_at": row['created_at'],
+        }
+        for row in rows
+    ]
+    return items, next_cursor
+
+
+def get_user_version(conn, user_id):
+    """
+    Версия истории пользователя: триггеры увеличивают её при каждом изменении
+    его записей в saved_prompts. Одно чтение по первичному ключу.
+    """
+    row = conn.execute("SELECT version FROM user_versions WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+def load_last_prompts(user_id, version=None):
+    """
+    Последний сохранённый positive- и negative-промпт пользователя.
+    Читается из таблицы last_prompts по первичному ключу (её обновляет триггер
+    на saved_prompts) и кэшируется в памяти процесса. Если передана версия
+    истории (get_user_version), кэш другой версии считается устаревшим.
+    """
+    cached = _last_prompts_cache.get(user_id)
+    if cached is not None and (version is None or cached[0] == version):
+        return cached[1]
+
+    result = {"positive": None, "negative": None}
+    with span("db_read"), get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT prompt_type, input_text, output_text FROM last_prompts WHERE user_id = ?",
+            (user_id,)
+        ).fetchall()
+    for row in rows:
+        if row['prompt_type'] in result:
+            result[row['prompt_type']] = {
+                "input": decode_text(row['input_text']),
+                "output": decode_text(row['output_text']),
+            }
+    _last_prompts_cache.put(user_id, (version, result))
+    return result
+
+
+def invalidate_last_prompts(user_id):
+    """Сбрасывает кэш последних промптов пользователя (вызывается после сохранения)"""
+    _last_prompts_cache.pop(user_id)
+
+
+def index_prompts(conn, rows):
+    """Добавляет записи (id, user_id, input_text, output_text) с несжатыми текстами в поиск"""
+    conn.executemany(_INDEX_PROMPT, rows)
+
+
+def unindex_prompts(conn, rows):
+    """
+    Убирает записи из поиска. Нужны те же несжатые тексты, что индексировались:
+    индекс с внешним содержимым вычитает именно их.
+    """
+    conn.executemany(_UNINDEX_PROMPT, rows)
+
+
+def rebuild_search_index(conn):
+    """Переиндексирует всю историю (после изменений saved_prompts в обход приложения)"""
+    conn.execute("INSERT INTO saved_prompts_fts (saved_prompts_fts) VALUES ('rebuild')")
+
+
+class SaveQueueFull(Exception):
+    """Очередь записи переполнена — клиенту стоит повторить запрос позже"""
+
+
+class _PendingSave:
+    __slots__ = ('rows', 'done', 'error')
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.done = threading.Event()
+        self.error = None
+
+
+class PromptWriter:
+    """
+    Отложенная запись saved_prompts: сохранения из разных запросов ставятся
+    в ограниченную очередь, отдельный поток пишет их пакетами до batch_size
+    строк. Пакет — всё, что накопилось за время предыдущей записи; подождать
+    добора (до flush_interval секунд) поток может только под нагрузкой.
+    """
+
+    def __init__(self, batch_size=SAVE_BATCH_SIZE, flush_interval=SAVE_FLUSH_INTERVAL, max_queue=SAVE_QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.rows_written = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def _ensure_started(self):
+        # Поток записи свой у каждого процесса (после fork воркера gunicorn запускается заново)
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue(self.max_queue)
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="prompt-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, rows, ack=None):
+        """
+        Ставит строки (user_id, prompt_type, input_text, output_text) в очередь.
+        При ack='commit' ждёт фиксации транзакции и пробрасывает её ошибку.
+        """
+        ack = ack if ack in ACK_MODES else SAVE_PROMPT_ACK
+        self._ensure_started()
+        pending = _PendingSave(rows)
+        try:
+            self._queue.put(pending, timeout=SAVE_ENQUEUE_TIMEOUT)
+        except queue.Full:
+            self.rejected += 1
+            raise SaveQueueFull()
+        if ack == 'commit':
+            if not pending.done.wait(SAVE_COMMIT_TIMEOUT):
+                raise sqlite3.OperationalError("Таймаут записи в БД")
+            if pending.error is not None:
+                raise pending.error
+
+    def _run(self):
+        # Групповая фиксация: одиночное сохранение пишется сразу, а всё, что
+        # накопилось в очереди, пока шла предыдущая транзакция, уходит одним пакетом
+        q = self._queue
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            batch = [item]
+            size = len(item.rows)
+            stop = self._drain(q, batch, size)
+            if not stop and len(batch) > 1 and self.flush_interval > 0:
+                # Под нагрузкой пакет ещё добирается, но не дольше flush_interval
+                stop = self._drain(q, batch, sum(len(pending.rows) for pending in batch),
+                                   time.monotonic() + self.flush_interval)
+            self._write(batch)
+            if stop:
+                return
+
+    def _drain(self, q, batch, size, deadline=None):
+        """Добирает пакет из очереди; True — получен сигнал остановки"""
+        while size < self.batch_size:
+            try:
+                if deadline is None:
+                    item = q.get_nowait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    item = q.get(timeout=remaining)
+            except queue.Empty:
+                return False
+            if item is None:
+                return True
+            batch.append(item)
+            size += len(item.rows)
+        return False
+
+    def _write(self, batch):
+        try:
+            # Длинные тексты сжимаются здесь, в потоке записи, а не в потоке запроса
+            rows = [
+                (row, (row[0], row[1], encode_text(row[2]), encode_text(row[3])))
+                for pending in batch for row in pending.rows
+            ]
+            with span("db_write"), get_db_connection() as conn:
+                index_rows = []
+                for (user_id, _, input_text, output_text), stored in rows:
+                    prompt_id = conn.execute(_INSERT_PROMPT, stored).lastrowid
+                    index_rows.append((prompt_id, user_id, input_text, output_text))
+                index_prompts(conn, index_rows)
+        except Exception as e:
+            if len(batch) > 1 and not isinstance(e, sqlite3.OperationalError):
+                # Одна плохая запись не должна ронять весь пакет — пишем по одной.
+                # OperationalError (БД заблокирована, нет места) так не лечится:
+                # повтор по одной лишь задержал бы поток на busy_timeout на каждую запись
+                for pending in batch:
+                    self._write([pending])
+                return
+            failed = sum(len(pending.rows) for pending in batch)
+            self.failed += failed
+            print(f"Prompt writer error: {e} ({failed} rows lost)")
+            for pending in batch:
+                pending.error = e
+        else:
+            self.batches += 1
+            self.rows_written += sum(len(pending.rows) for pending in batch)
+        for pending in batch:
+            for row in pending.rows:
+                invalidate_last_prompts(row[0])
+            pending.done.set()
+
+    def close(self):
+        """Записывает остаток очереди и останавливает поток (при завершении процесса)"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "batches": self.batches,
+            "rows_written": self.rows_written,
+            "rejected": self.rejected,
+            "failed": self.failed,
+        }
+
+
+prompt_writer = PromptWriter()
+atexit.register(prompt_writer.close)
@@ -0,0 +1,35 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# Настройки должны быть выставлены до импорта модулей приложения:
+# без YandexGPT, хэширование паролей в потоке запроса
+os.environ.pop('YANDEX_API_KEY', None)
+os.environ.pop('YANDEX_FOLDER_ID', None)
+os.environ['PASSWORD_HASH_WORKERS'] = '0'
+os.environ['AI_REUSE_ENABLED'] = '0'
+
+import database  # noqa: E402
+
+# Вся сессия тестов работает с временной БД (app вызывает init_db при импорте)
+database.DB_NAME = os.path.join(tempfile.mkdtemp(prefix='tests-'), 'test.db')
+database.init_db()
+
+
+@pytest.fixture
+def stub_upstream():
+    """Заглушка YandexGPT из бенчмарков: (StubHandler, url); доля ошибок сбрасывается после теста"""
+    from benchmarks.stub_yandex import StubHandler, start_stub
+    server, url = start_stub()
+    StubHandler.requests_served = 0
+    yield StubHandler, url
+    server.shutdown()
+    server.server_close()
+    StubHandler.error_rate = 0.0
+    StubHandler.error_status = 503
@@ -0,0 +1,101 @@
+import gzip
+import json
+
+import jwt
+import pytest
+
+import http_cache
+from app import app
+from database import get_db_connection
+
+
+@pytest.fixture(scope='module')
+def client():
+    return app.test_client()
+
+
+@pytest.fixture
+def auth(request):
+    """Заголовок авторизации нового пользователя (у каждого теста своя история)"""
+    with get_db_connection() as conn:
+        user_id = conn.execute(
+            "INSERT INTO users (username, password_hash) VALUES (?, 'x')", (request.node.name,)
+        ).lastrowid
+    token = jwt.encode({'user_id': user_id}, app.config['SECRET_KEY'], algorithm="HS256")
+    return {'Authorization': f'Bearer {token}'}
+
+
+def save(client, auth, count, text='запрос'):
+    prompts = [{"type": "text", "input": f"{text} {i}", "output": "ответ " * 20} for i in range(count)]
+    response = client.post('/api/save_prompts', json={"prompts": prompts, "ack": "commit"}, headers=auth)
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize('path', ['/api/history', '/api/get_last_prompts'])
+def test_repeat_request_gets_304(client, auth, path):
+    save(client, auth, 2)
+    first = client.get(path, headers=auth)
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+
+    second = client.get(path, headers={**auth, 'If-None-Match': etag})
+    assert second.status_code == 304
+    assert second.headers['ETag'] == etag
+    assert second.get_data() == b''
+
+
+@pytest.mark.parametrize('if_none_match', ['W/{etag}', '*', '"other", {etag}'])
+def test_weak_star_and_list_tags_match(client, auth, if_none_match):
+    save(client, auth, 1)
+    etag = client.get('/api/history', headers=auth).headers['ETag']
+    response = client.get('/api/history', headers={**auth, 'If-None-Match': if_none_match.format(etag=etag)})
+    assert response.status_code == 304
+
+
+def test_etag_changes_after_save(client, auth):
+    save(client, auth, 1)
+    etag = client.get('/api/history', headers=auth).headers['ETag']
+    save(client, auth, 1, text='новый')
+    response = client.get('/api/history', headers={**auth, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_etag_depends_on_page_parameters(client, auth):
+    save(client, auth, 3)
+    full = client.get('/api/history', headers=auth).headers['ETag']
+    page = client.get('/api/history?limit=1', headers=auth)
+    assert page.headers['ETag'] != full
+    assert page.headers['X-Next-Cursor']
+
+
+def test_small_response_is_not_compressed(client, auth):
+    save(client, auth, 1)
+    response = client.get('/api/history?limit=1&preview=1', headers={**auth, 'Accept-Encoding': 'gzip'})
+    assert len(response.get_data()) < http_cache.RESPONSE_COMPRESS_MIN_BYTES
+    assert 'Content-Encoding' not in response.headers
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'br'])
+def test_compressed_response_and_its_etag(client, auth, encoding):
+    if encoding not in http_cache.ENCODINGS:
+        pytest.skip("пакет brotli не установлен")
+    save(client, auth, 30)
+    plain = client.get('/api/history', headers={**auth, 'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in plain.headers
+
+    response = client.get('/api/history', headers={**auth, 'Accept-Encoding': encoding})
+    assert response.headers['Content-Encoding'] == encoding
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert response.headers['ETag'] == plain.headers['ETag'][:-1] + f'-{encoding}"'
+    if encoding == 'gzip':
+        data = gzip.decompress(response.get_data())
+    else:
+        data = http_cache.brotli.decompress(response.get_data())
+    assert json.loads(data) == plain.get_json()
+
+    # Тег сжатого представления подходит и для несжатого запроса, и наоборот
+    for accept, etag in ((encoding, response.headers['ETag']), ('identity', response.headers['ETag']),
+                         (encoding, plain.headers['ETag'])):
+        revalidated = client.get('/api/history', headers={**auth, 'Accept-Encoding': accept, 'If-None-Match': etag})
+        assert revalidated.status_code == 304
@@ -0,0 +1,102 @@
+import queue
+import sqlite3
+
+import pytest
+
+import prompt_store
+from database import get_db_connection
+from prompt_store import PromptWriter, _PendingSave, decode_cursor, encode_cursor
+
+
+def saved_inputs(user_id):
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT input_text FROM saved_prompts WHERE user_id = ? ORDER BY id", (user_id,)
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor('2024-06-01 12:00:00', 42)
+    assert '=' not in cursor
+    assert decode_cursor(cursor) == ('2024-06-01 12:00:00', 42)
+
+
+@pytest.mark.parametrize('cursor', ['', '!!!', encode_cursor('2024-06-01', 'x'), 'bm90LWEtY3Vyc29y'])
+def test_bad_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_offset_cursor_bounds():
+    assert prompt_store._decode_offset(prompt_store._encode_offset(20)) == 20
+    with pytest.raises(ValueError):
+        prompt_store._decode_offset(prompt_store._encode_offset(prompt_store.SEARCH_MAX_OFFSET + 1))
+
+
+def test_submit_commits_before_returning():
+    writer = PromptWriter()
+    try:
+        writer.submit([(101, 'text', 'первый', 'ответ'), (101, 'text', 'второй', 'ответ')], ack='commit')
+        assert saved_inputs(101) == ['первый', 'второй']
+        assert writer.stats()['rows_written'] == 2
+    finally:
+        writer.close()
+
+
+def test_batch_is_written_in_one_transaction():
+    writer = PromptWriter()
+    batch = [_PendingSave([(102, 'text', f'запись {i}', 'ответ')]) for i in range(3)]
+    writer._write(batch)
+    assert saved_inputs(102) == ['запись 0', 'запись 1', 'запись 2']
+    assert writer.batches == 1
+    assert all(pending.done.is_set() and pending.error is None for pending in batch)
+
+
+def test_bad_row_does_not_fail_the_whole_batch():
+    writer = PromptWriter()
+    good = _PendingSave([(103, 'text', 'хорошая', 'ответ')])
+    bad = _PendingSave([(None, 'text', 'без пользователя', 'ответ')])  # user_id NOT NULL
+    writer._write([good, bad])
+    assert saved_inputs(103) == ['хорошая']
+    assert good.error is None
+    assert isinstance(bad.error, sqlite3.IntegrityError)
+    assert writer.failed == 1
+    assert bad.done.is_set()
+
+
+def test_operational_error_is_not_retried_row_by_row(monkeypatch):
+    calls = []
+
+    def locked_connection():
+        calls.append(1)
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(prompt_store, 'get_db_connection', locked_connection)
+    writer = PromptWriter()
+    batch = [_PendingSave([(104, 'text', f'запись {i}', 'ответ')]) for i in range(3)]
+    writer._write(batch)
+    assert len(calls) == 1
+    assert writer.failed == 3
+    assert all(isinstance(pending.error, sqlite3.OperationalError) for pending in batch)
+
+
+def test_submit_raises_commit_error():
+    writer = PromptWriter()
+    try:
+        with pytest.raises(sqlite3.IntegrityError):
+            writer.submit([(None, 'text', 'без пользователя', 'ответ')], ack='commit')
+    finally:
+        writer.close()
+
+
+def test_full_queue_is_rejected(monkeypatch):
+    monkeypatch.setattr(prompt_store, 'SAVE_ENQUEUE_TIMEOUT', 0.01)
+    writer = PromptWriter(max_queue=1)
+    # Поток записи не запущен, поэтому очередь никто не разбирает
+    monkeypatch.setattr(writer, '_ensure_started', lambda: None)
+    writer._queue = queue.Queue(1)
+    writer.submit([(105, 'text', 'в очереди', 'ответ')], ack='enqueue')
+    with pytest.raises(prompt_store.SaveQueueFull):
+        writer.submit([(105, 'text', 'лишняя', 'ответ')], ack='enqueue')
+    assert writer.rejected == 1
@@ -0,0 +1,102 @@
+import time
+
+import pytest
+
+import yandex_ai
+from metrics import UPSTREAM_RESPONSES
+from yandex_ai import CircuitBreaker, YandexGPTClient
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(yandex_ai, 'YANDEX_BACKOFF_BASE', 0.001)
+    monkeypatch.setattr(yandex_ai, 'YANDEX_BACKOFF_MAX', 0.01)
+
+
+def make_client(url, **kwargs):
+    return YandexGPTClient('key', 'folder', url=url, cache=None, similar=None, **kwargs)
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_success_resets_failures():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_half_open_lets_one_probe_through():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    assert not breaker.allow()
+    time.sleep(0.02)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+    # Неудачная проба снова размыкает цепь, удачная — замыкает
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    time.sleep(0.02)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_generate_uses_upstream(stub_upstream):
+    handler, url = stub_upstream
+    text, reused = make_client(url).generate('напиши функцию сортировки', 'gpt-4o')
+    assert 'напиши функцию сортировки' in text
+    assert not reused
+    assert handler.requests_served == 1
+
+
+def test_retries_then_gives_up_on_5xx(stub_upstream):
+    handler, url = stub_upstream
+    handler.error_rate = 1.0
+    client = make_client(url, max_retries=2)
+    assert client.generate('задача', 'gpt-4o') == (None, False)
+    assert handler.requests_served == 3
+    assert client.breaker.failures == 1
+
+
+def test_client_error_is_not_retried_and_keeps_breaker_closed(stub_upstream):
+    handler, url = stub_upstream
+    handler.error_rate = 1.0
+    handler.error_status = 400
+    client = make_client(url, max_retries=2, breaker=CircuitBreaker(threshold=1))
+    assert client.generate('задача', 'gpt-4o') == (None, False)
+    assert handler.requests_served == 1
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_open_breaker_skips_upstream(stub_upstream):
+    handler, url = stub_upstream
+    handler.error_rate = 1.0
+    client = make_client(url, max_retries=0, breaker=CircuitBreaker(threshold=1, reset_timeout=60))
+    assert client.generate('задача', 'gpt-4o') == (None, False)
+    assert client.breaker.state == CircuitBreaker.OPEN
+
+    handler.error_rate = 0.0
+    assert client.generate('задача', 'gpt-4o') == (None, False)
+    assert handler.requests_served == 1
+
+
+def test_connection_error_is_retried():
+    # На этом порту никто не слушает: соединение отклоняется сразу
+    before = UPSTREAM_RESPONSES._values.get(("connection_error",), 0)
+    client = make_client('http://127.0.0.1:9/completion', max_retries=1)
+    assert client.generate('задача', 'gpt-4o') == (None, False)
+    assert UPSTREAM_RESPONSES._values[("connection_error",)] - before == 2
+    assert client.breaker.failures == 1
@@ -0,0 +1,46 @@
+import hashlib
+import os
+
+import jwt
+
+from lru import LRUCache
+
+# Сколько проверенных токенов держать в памяти процесса
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+
+
+class VerifiedTokenCache:
+    """
+    LRU уже проверенных JWT. Ключ — хэш токена (сам токен в памяти не храним),
+    запись живёт до exp токена, поэтому истёкший токен снова проходит
+    через jwt.decode и получает те же ошибки, что и без кэша.
+    """
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self._cache = LRUCache(maxsize)
+
+    @staticmethod
+    def _key(token, secret):
+        return hashlib.sha256(f"{secret}\x00{token}".encode('utf-8')).digest()
+
+    def decode(self, token, secret):
+        """Аналог jwt.decode(token, secret, algorithms=["HS256"]) с кэшированием результата"""
+        key = self._key(token, secret)
+        payload = self._cache.get(key)
+        if payload is not None:
+            return payload
+        payload = jwt.decode(token, secret, algorithms=["HS256"])
+        exp = payload.get('exp')
+        # Токены без срока жизни не кэшируем
+        if isinstance(exp, (int, float)):
+            self._cache.put(key, payload, expires_at=exp)
+        return payload
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
+
+
+token_cache = VerifiedTokenCache()
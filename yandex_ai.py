@@ -1,87 +1,403 @@
 import os
+import random
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import json
 import re
-from typing import Optional
+from typing import Iterator, Optional, Tuple
+
+from ai_cache import ResponseCache, make_key, response_cache
+from metrics import UPSTREAM_RESPONSES, observe_stage
+from near_duplicates import SimilarityIndex, similarity_index
+
+# Настройки HTTP-клиента YandexGPT
+YANDEX_GPT_URL = os.environ.get('YANDEX_GPT_URL', "https://llm.api.cloud.yandex.net/foundationModels/v1/completion")
+YANDEX_CONNECT_TIMEOUT = float(os.environ.get('YANDEX_CONNECT_TIMEOUT', 3.05))
+YANDEX_READ_TIMEOUT = float(os.environ.get('YANDEX_READ_TIMEOUT', 30))
+# Соединений на потоки обработки запросов (пакетная генерация добавляет свои, см. app.py)
+YANDEX_POOL_SIZE = int(os.environ.get('YANDEX_POOL_SIZE', 10))
+YANDEX_MAX_RETRIES = int(os.environ.get('YANDEX_MAX_RETRIES', 2))
+YANDEX_BACKOFF_BASE = float(os.environ.get('YANDEX_BACKOFF_BASE', 0.5))
+YANDEX_BACKOFF_MAX = float(os.environ.get('YANDEX_BACKOFF_MAX', 4))
+YANDEX_BREAKER_THRESHOLD = int(os.environ.get('YANDEX_BREAKER_THRESHOLD', 5))
+YANDEX_BREAKER_RESET = float(os.environ.get('YANDEX_BREAKER_RESET', 30))
+
+class YandexGPTStreamError(Exception):
+    """Потоковый ответ оборвался после того, как часть текста уже была отдана"""
+
+
+# Ответы, после которых имеет смысл повторить запрос
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class CircuitBreaker:
+    """
+    Размыкатель цепи для апстрима: после threshold ошибок подряд запросы
+    не отправляются reset_timeout секунд (сразу идём в БД), затем
+    пропускается один пробный запрос.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold: int = YANDEX_BREAKER_THRESHOLD, reset_timeout: float = YANDEX_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Пропускаем один пробный запрос
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    print(f"YandexGPT circuit breaker opened after {self.failures} failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+# Время установки соединений с апстримом в текущем потоке (TCP + TLS)
+_connect_time = threading.local()
+
+
+def _record_connect(start: float):
+    elapsed = time.perf_counter() - start
+    _connect_time.value = getattr(_connect_time, 'value', 0.0) + elapsed
+    observe_stage("upstream_connect", elapsed)
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _record_connect(start)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _record_connect(start)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter, отдельно замеряющий время установки соединения"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
 
 class YandexGPTClient:
-    def __init__(self, api_key: str, folder_id: str, model: str = "yandexgpt"):
+    def __init__(self, api_key: str, folder_id: str, model: str = "yandexgpt",
+                 cache: Optional[ResponseCache] = response_cache, url: str = YANDEX_GPT_URL,
+                 connect_timeout: float = YANDEX_CONNECT_TIMEOUT, read_timeout: float = YANDEX_READ_TIMEOUT,
+                 pool_size: int = YANDEX_POOL_SIZE, max_retries: int = YANDEX_MAX_RETRIES,
+                 breaker: Optional[CircuitBreaker] = None,
+                 similar: Optional[SimilarityIndex] = similarity_index):
         self.api_key = api_key
         self.folder_id = folder_id
         self.model = model
-        self.url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+        self.url = url
+        self.cache = cache
+        self.similar = similar
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.breaker = breaker or CircuitBreaker()
         self.headers = {
             "Authorization": f"Api-Key {self.api_key}",
             "x-folder-id": self.folder_id,
             "Content-Type": "application/json"
         }
+        self.session = self._make_session(pool_size)
 
-    def generate_prompt(self, user_input: str, model_key: str, locale: str = 'ru', use_instructions: bool = False) -> Optional[str]:
-            # 1. Извлекаем инструкции из текста (то, что в кавычках или скобках)
-            instructions = ""
-            if use_instructions:
-                # Находим всё, что в (...) или "..."
-                found = re.findall(r'[\(\"\'](.*?)[\)\"\']', user_input)
-                if found:
-                    instructions = ", ".join(found)
-                    # Удаляем инструкции из основного текста задачи, чтобы не дублировались
-                    clean_task = re.sub(r'[\(\"\'].*?[\)\"\']', '', user_input).strip()
-                else:
-                    clean_task = user_input
+    def _make_session(self, pool_size: int):
+        """Постоянная сессия: keep-alive и пул соединений вместо нового TLS-рукопожатия на каждый вызов"""
+        session = requests.Session()
+        adapter = _TimedHTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _prepare(self, user_input: str, model_key: str, use_instructions: bool = False) -> Tuple[str, str, dict]:
+        """Разбирает ввод пользователя и собирает тело запроса к API: (clean_task, instructions, body)"""
+        # 1. Извлекаем инструкции из текста (то, что в кавычках или скобках)
+        instructions = ""
+        if use_instructions:
+            # Находим всё, что в (...) или "..."
+            found = re.findall(r'[\(\"\'](.*?)[\)\"\']', user_input)
+            if found:
+                instructions = ", ".join(found)
+                # Удаляем инструкции из основного текста задачи, чтобы не дублировались
+                clean_task = re.sub(r'[\(\"\'].*?[\)\"\']', '', user_input).strip()
             else:
                 clean_task = user_input
-    
-            # 2. Очищаем задачу от "[Контекст модели]: ..."
-            clean_task = re.sub(r'\[.*?\]', '', clean_task).strip()
-    
-            # 3. Формируем "Архитектурный" системный промпт
-            system_prompt = (
-                f"Ты — профессиональный инженер промптов. Твоя задача — создать идеальный промпт для модели {model_key}. "
-                f"Используй следующий запрос пользователя: '{clean_task}'. "
-                "Ответ должен содержать: Роль ИИ, саму задачу, ограничения и требуемый формат ответа. "
-                "Не используй пояснения от себя, выдай только готовый промпт."
-            )
-    
-            body = {
-                "modelUri": f"gpt://{self.folder_id}/{self.model}",
-                "completionOptions": {"stream": False, "temperature": 0.6, "maxTokens": 500},
-                "messages": [
-                    {"role": "system", "text": system_prompt},
-                    {"role": "user", "text": f"Задача: {clean_task}. Инструкции: {instructions}" if instructions else f"Задача: {clean_task}"}
-                ]
-            }
+        else:
+            clean_task = user_input
+
+        # 2. Очищаем задачу от "[Контекст модели]: ..."
+        clean_task = re.sub(r'\[.*?\]', '', clean_task).strip()
+
+        # 3. Формируем "Архитектурный" системный промпт
+        system_prompt = (
+            f"Ты — профессиональный инженер промптов. Твоя задача — создать идеальный промпт для модели {model_key}. "
+            f"Используй следующий запрос пользователя: '{clean_task}'. "
+            "Ответ должен содержать: Роль ИИ, саму задачу, ограничения и требуемый формат ответа. "
+            "Не используй пояснения от себя, выдай только готовый промпт."
+        )
 
+        body = {
+            "modelUri": f"gpt://{self.folder_id}/{self.model}",
+            "completionOptions": {"stream": False, "temperature": 0.6, "maxTokens": 500},
+            "messages": [
+                {"role": "system", "text": system_prompt},
+                {"role": "user", "text": f"Задача: {clean_task}. Инструкции: {instructions}" if instructions else f"Задача: {clean_task}"}
+            ]
+        }
+        return clean_task, instructions, body
+
+    def _backoff(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        """Пауза перед повтором: экспоненциальная с джиттером, не больше YANDEX_BACKOFF_MAX"""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                return min(float(retry_after), YANDEX_BACKOFF_MAX)
+        delay = min(YANDEX_BACKOFF_MAX, YANDEX_BACKOFF_BASE * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
+
+    def _upstream_allowed(self) -> bool:
+        """Можно ли сейчас обращаться к апстриму (цепь не разомкнута)"""
+        if self.breaker.allow():
+            return True
+        UPSTREAM_RESPONSES.inc("circuit_open")
+        return False
+
+    def _error_delay(self, error: Exception, attempt: int, connection_error: bool, timeout: bool) -> Optional[float]:
+        """
+        Учитывает ошибку транспорта (общая часть синхронного и асинхронного клиента).
+        Возвращает паузу перед повтором или None — повторять не нужно.
+        """
+        if connection_error:
+            UPSTREAM_RESPONSES.inc("connection_error")
+            # Сюда же попадает таймаут соединения; таймаут чтения не повторяем
+            if attempt < self.max_retries:
+                return self._backoff(attempt)
+        else:
+            UPSTREAM_RESPONSES.inc("timeout" if timeout else "error")
+        print(f"YandexGPT Connection error: {error}")
+        self.breaker.record_failure()
+        return None
+
+    def _response_delay(self, response, attempt: int, elapsed: float) -> Optional[float]:
+        """
+        Учитывает ответ апстрима (общая часть синхронного и асинхронного клиента).
+        elapsed — время ответа (до заголовков) без учёта установки соединения.
+        Возвращает паузу перед повтором или None: ответ окончательный — успешный
+        (status_code 200) либо ошибка.
+        """
+        observe_stage("upstream_response", elapsed)
+        UPSTREAM_RESPONSES.inc(str(response.status_code))
+        if response.status_code == 200:
+            self.breaker.record_success()
+            return None
+
+        if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+            return self._backoff(attempt, response)
+
+        # Если ошибка, выводим подробный ответ от API
+        print(f"--- YandexGPT API ERROR {response.status_code} ---")
+        print(f"Response: {response.text}")
+        if response.status_code in RETRY_STATUSES:
+            self.breaker.record_failure()
+        else:
+            # Апстрим отвечает — ошибка в самом запросе, а не в его доступности
+            self.breaker.record_success()
+        return None
+
+    def _post(self, body: dict, stream: bool = False) -> Optional[requests.Response]:
+        """
+        Отправляет запрос с повторами на 429/5xx и ошибки соединения.
+        Возвращает успешный ответ или None (ошибка, либо цепь разомкнута).
+        """
+        if not self._upstream_allowed():
+            return None
+
+        for attempt in range(self.max_retries + 1):
+            _connect_time.value = 0.0
+            start = time.perf_counter()
             try:
-                response = requests.post(self.url, headers=self.headers, json=body, timeout=30)
-            
-            # Если ошибка, выводим подробный ответ от API
-                if response.status_code != 200:
-                    print(f"--- YandexGPT API ERROR {response.status_code} ---")
-                    print(f"Response: {response.text}")
+                response = self.session.post(self.url, headers=self.headers, json=body,
+                                             timeout=self.timeout, stream=stream)
+            except requests.RequestException as e:
+                delay = self._error_delay(e, attempt, isinstance(e, requests.ConnectionError),
+                                          isinstance(e, requests.Timeout))
+                if delay is None:
                     return None
-            
-                data = response.json()
-                result_text = data["result"]["alternatives"][0]["message"]["text"]
-                
-                # ДОБАВЛЯЕМ ИНСТРУКЦИИ В КОНЕЦ БЕЗ ИЗМЕНЕНИЙ:
-                if use_instructions and instructions:
-                    result_text += f"\n\nИнструкции: {instructions}"
-                    
-                return result_text
-            
-            except Exception as e:
-                print(f"YandexGPT Connection error: {e}")
-                return None
+                time.sleep(delay)
+                continue
+
+            delay = self._response_delay(response, attempt, time.perf_counter() - start - _connect_time.value)
+            if delay is None:
+                return response if response.status_code == 200 else None
+            response.close()
+            time.sleep(delay)
+        return None
+
+    def _result_text(self, data: dict, instructions: str) -> str:
+        """Достаёт текст ответа из JSON API"""
+        result_text = data["result"]["alternatives"][0]["message"]["text"]
+
+        # ДОБАВЛЯЕМ ИНСТРУКЦИИ В КОНЕЦ БЕЗ ИЗМЕНЕНИЙ:
+        if instructions:
+            result_text += f"\n\nИнструкции: {instructions}"
+
+        return result_text
+
+    def _complete(self, body: dict, instructions: str) -> Optional[str]:
+        """Выполняет запрос к API и возвращает текст ответа (или None при ошибке)"""
+        response = self._post(body)
+        if response is None:
+            return None
+        try:
+            return self._result_text(response.json(), instructions)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            print(f"YandexGPT bad response: {e}")
+            return None
+
+    def _similar_scope(self, model_key: str, instructions: str) -> str:
+        """Похожие запросы ищутся только среди ответов для той же модели и тех же инструкций"""
+        return make_key(self.model, model_key, instructions)
+
+    def _complete_and_index(self, body: dict, instructions: str, scope: str, clean_task: str) -> Optional[str]:
+        result = self._complete(body, instructions)
+        if result is not None and self.similar is not None:
+            self.similar.add(scope, clean_task, result)
+        return result
+
+    def generate(self, user_input: str, model_key: str, locale: str = 'ru',
+                 use_instructions: bool = False) -> Tuple[Optional[str], bool]:
+        """
+        Возвращает (текст, reused). reused=True — это готовый ответ на почти
+        такой же запрос (см. near_duplicates), апстрим не вызывался.
+        """
+        clean_task, instructions, body = self._prepare(user_input, model_key, use_instructions)
+        if self.cache is None:
+            return self._complete(body, instructions), False
+        # Одинаковые (clean_task, model_key, instructions) обслуживаются из кэша
+        key = make_key(self.model, model_key, clean_task, instructions)
+        if self.similar is None:
+            return self.cache.get_or_compute(key, lambda: self._complete(body, instructions)), False
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached, False
+        scope = self._similar_scope(model_key, instructions)
+        similar = self.similar.lookup(scope, clean_task)
+        if similar is not None:
+            return similar, True
+        return self.cache.get_or_compute(
+            key, lambda: self._complete_and_index(body, instructions, scope, clean_task)), False
+
+    def generate_prompt(self, user_input: str, model_key: str, locale: str = 'ru', use_instructions: bool = False) -> Optional[str]:
+        return self.generate(user_input, model_key, locale, use_instructions)[0]
+
+    def stream_prompt(self, user_input: str, model_key: str, locale: str = 'ru', use_instructions: bool = False) -> Optional[Iterator[str]]:
+        """
+        Потоковый вариант generate_prompt: возвращает итератор по новым
+        фрагментам текста или None, если поток не удалось начать.
+        Обрыв посреди потока поднимает YandexGPTStreamError.
+        """
+        clean_task, instructions, body = self._prepare(user_input, model_key, use_instructions)
+        key = make_key(self.model, model_key, clean_task, instructions)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return iter((cached,))
+
+        body["completionOptions"] = dict(body["completionOptions"], stream=True)
+        response = self._post(body, stream=True)
+        if response is None:
+            return None
+        return self._iter_stream(response, key, instructions)
+
+    def _iter_stream(self, response: requests.Response, key: str, instructions: str) -> Iterator[str]:
+        # В потоковом режиме API присылает JSON-объекты построчно, каждый — с полным текстом на текущий момент
+        text = ""
+        try:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                current = data["result"]["alternatives"][0]["message"]["text"]
+                if len(current) > len(text):
+                    yield current[len(text):]
+                    text = current
+        except (requests.RequestException, ValueError, KeyError, IndexError, TypeError) as e:
+            print(f"YandexGPT stream error: {e}")
+            self.breaker.record_failure()
+            raise YandexGPTStreamError(str(e)) from e
+        finally:
+            response.close()
+
+        # ДОБАВЛЯЕМ ИНСТРУКЦИИ В КОНЕЦ БЕЗ ИЗМЕНЕНИЙ:
+        if instructions:
+            tail = f"\n\nИнструкции: {instructions}"
+            text += tail
+            yield tail
+        if text and self.cache is not None:
+            self.cache.put(key, text)
 
 # Глобальный экземпляр клиента (будет инициализирован в app.py)
 yandex_client: Optional[YandexGPTClient] = None
 
-def init_yandex_gpt(api_key: str, folder_id: str):
+def init_yandex_gpt(api_key: str, folder_id: str, pool_size: int = YANDEX_POOL_SIZE):
     global yandex_client
-    yandex_client = YandexGPTClient(api_key, folder_id)
+    yandex_client = YandexGPTClient(api_key, folder_id, pool_size=pool_size)
+
+def is_ai_available() -> bool:
+    return yandex_client is not None
+
+def generate_with_ai(user_input: str, model_key: str, locale: str = 'ru', use_instructions: bool = False) -> Tuple[Optional[str], bool]:
+    """(текст, reused) — см. YandexGPTClient.generate"""
+    if yandex_client is None:
+        print("YandexGPT клиент не инициализирован")
+        return None, False
+    return yandex_client.generate(user_input, model_key, locale, use_instructions)
 
-def generate_with_ai(user_input: str, model_key: str, locale: str = 'ru', use_instructions: bool = False) -> Optional[str]:
+def stream_with_ai(user_input: str, model_key: str, locale: str = 'ru', use_instructions: bool = False) -> Optional[Iterator[str]]:
     if yandex_client is None:
         print("YandexGPT клиент не инициализирован")
         return None
-    return yandex_client.generate_prompt(user_input, model_key, locale, use_instructions)
+    return yandex_client.stream_prompt(user_input, model_key, locale, use_instructions)